@@ -44,6 +44,12 @@ if __name__ == "__main__":
         action="store_true",
         default=False,
         help="generate simulation scripts")
+    group.add_argument(
+        "--run-local",
+        dest="run_local",
+        action="store_true",
+        default=False,
+        help="run simulations on this machine, without a server")
     group.add_argument(
         "--run-server",
         dest="run_server",
@@ -75,6 +81,7 @@ if __name__ == "__main__":
     args = parser.parse_args()
     required = [
         args.generate,
+        args.run_local,
         args.run_server,
         args.run_client,
         args.process,
@@ -102,8 +109,18 @@ if __name__ == "__main__":
             cmd.append("-f")
         run_cmd(cmd)
 
+    # run experiment locally
+    if args.run_local or args.all:
+        cmd = [
+            "python", BIN_PATH.joinpath("simulate/run_simulations.py"),
+            "local", "-e", exp, "-t", tag
+        ]
+        if force:
+            cmd.append("-f")
+        run_cmd(cmd)
+
     # run experiment server
-    if args.run_server or args.all:
+    if args.run_server:
         cmd = [
             "python", BIN_PATH.joinpath("simulate/run_simulations.py"),
             "server", "-e", exp, "-t", tag, "-k", "zo7MV6GndfNf"
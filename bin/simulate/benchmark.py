@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+
+"""Micro-benchmarks for the hot paths of the simulations."""
+
+import argparse
+import multiprocessing as mp
+import time
+import timeit
+import numpy as np
+import pandas as pd
+
+from path import path
+from scenesim.objects.pso import PSO
+from scenesim.objects.sso import SSO
+
+from mass import CPO_PATH
+from mass.sims.build import build_noises, build_forces
+from mass.sims.client import PersistentRunner
+from mass.sims.reducers import FallReducer
+from mass.sims.server import ServerManager
+from mass.sims.simulation import read
+from mass.sims.storage import unpack
+from mass.sims.tasks import Tasks, with_slices
+from mass.sims.utils import get_params, load_cpo
+from query_model import process_model_nmoved
+
+
+def compare(name, baseline, candidate, number, repeat, per=1, unit="call"):
+    """Time two implementations of the same thing and print how long
+    each takes per `unit` (where one call does `per` units), and the
+    speedup of `candidate` over `baseline`."""
+    n = number * per
+    t0 = min(timeit.repeat(baseline, number=number, repeat=repeat)) / n
+    t1 = min(timeit.repeat(candidate, number=number, repeat=repeat)) / n
+
+    print "%s (best of %d, %d calls each)" % (name, repeat, number)
+    print "  baseline : %10.2f us/%s" % (t0 * 1e6, unit)
+    print "  candidate: %10.2f us/%s" % (t1 * 1e6, unit)
+    print "  speedup  : %10.2fx" % (t0 / t1)
+
+
+def benchmark_read(args):
+    """Compare `read` against building a list of stacked arrays."""
+    cpo = load_cpo(path(CPO_PATH.joinpath(args.cpo)))
+    scene = SSO("scene")
+    cpo.reparentTo(scene)
+    scene.init_tree(tags=())
+    pcpos = cpo.descendants(type_=PSO)
+
+    data0 = np.zeros((len(pcpos), 7))
+    data1 = np.zeros((len(pcpos), 7))
+
+    def baseline():
+        data0[:] = [
+            np.hstack((pcpo.getPos(), pcpo.getQuat())) for pcpo in pcpos]
+
+    def candidate():
+        read(data1, pcpos)
+
+    baseline()
+    candidate()
+    if not (data0 == data1).all():
+        raise AssertionError("read does not match the baseline")
+
+    compare("read: %d objects" % len(pcpos),
+            baseline, candidate, args.number, args.repeat)
+
+
+def benchmark_params(args):
+    """Compare looking up the noise and force of each condition
+    through the server's params proxy against reading them from a task
+    that carries them."""
+    rso = np.random.RandomState(0)
+    shape = (args.num_stims, args.num_samples)
+    params = {
+        'noises': build_noises([0.04], shape + (args.num_objs,), rso),
+        'forces': build_forces([0.2], shape, rso),
+    }
+
+    ServerManager.register_shared(with_callable=True, params=params)
+    mgr = ServerManager(address=("127.0.0.1", 0), authkey="benchmark")
+    mgr.start()
+    proxy = mgr.get_params()
+
+    conditions = [
+        ((0, 0.04), (0, 0.2), (0, 0.0), (isamp, isamp))
+        for isamp in xrange(args.num_samples)]
+    task = with_slices(
+        {'icpo': 0, 'conditions': conditions},
+        params['noises'], params['forces'])
+
+    def baseline():
+        for (iS, S), (iP, P), (iK, K), (isamp, samp) in conditions:
+            proxy['noises'][iS, 0, isamp]
+            proxy['forces'][iP, 0, isamp]
+
+    def candidate():
+        for icond in xrange(len(conditions)):
+            task['noises'][icond]
+            task['forces'][icond]
+
+    try:
+        compare("params: %d stimuli, %d samples, %d objects" % (
+            args.num_stims, args.num_samples, args.num_objs),
+            baseline, candidate, args.number, args.repeat,
+            per=len(conditions), unit="condition")
+    finally:
+        mgr.shutdown()
+
+
+class FakeDataPackage(object):
+    """Just enough of a `DataPackage` for `process_model_nmoved`."""
+
+    def __init__(self, **resources):
+        self.resources = resources
+
+    def load_resource(self, name):
+        return self.resources[name]
+
+
+def benchmark_reducers(args):
+    """Compare computing the fall statistics from stored trajectories
+    (`query_model.process_model_nmoved`) against computing them with
+    `FallReducer`, on random trajectories where some blocks are NaN,
+    and check that both give the same statistics."""
+    rso = np.random.RandomState(0)
+    stim = "stim_0_%s" % "".join(
+        str(x) for x in rso.randint(0, 2, args.num_objs))
+    objects = ["obj%02d" % i for i in xrange(args.num_objs)]
+    index_names = [
+        'sigma', 'phi', 'kappa', 'stimulus', 'sample',
+        'timestep_index', 'object', 'posquat']
+    index_levels = {
+        'sigma': [0.0, 0.04],
+        'phi': [0.0],
+        'kappa': [-1.0, 1.0],
+        'stimulus': [stim],
+        'sample': range(args.num_samples),
+        'timestep_index': [0, 1, -1],
+        'object': objects,
+        'posquat': ['x', 'y', 'z', 'w', 'i', 'j', 'k'],
+    }
+
+    # blocks either stay close to where they were, or fall off
+    shape = [len(index_levels[x]) for x in index_names]
+    data = np.zeros(shape)
+    data[..., 0, :, :3] = rso.uniform(-1, 1, shape[:5] + [shape[6], 3])
+    data[..., 1, :, :3] = data[..., 0, :, :3]
+    moves = rso.normal(0, 0.02, shape[:5] + [shape[6], 3])
+    fell = rso.rand(*(shape[:5] + [shape[6]])) < 0.3
+    moves[fell] *= 10
+    data[..., 2, :, :3] = data[..., 1, :, :3] + moves
+    missing = rso.rand(*(shape[:5] + [shape[6]])) < 0.05
+    data[..., 2, :, :][missing] = np.nan
+
+    dp = FakeDataPackage(**{
+        'simulation_metadata': {
+            'index_names': index_names,
+            'index_levels': index_levels,
+        },
+        'simulations.npy': data,
+    })
+    task = {'cpo_path': "%s.cpo" % stim, 'bodies': objects}
+    params = {'simulation': {}}
+    keys = ['sigma', 'phi', 'kappa', 'stimulus', 'sample']
+
+    result = {}
+
+    def baseline():
+        result['baseline'] = process_model_nmoved(dp)
+
+    def candidate():
+        reducer = FallReducer(task, params)
+        rows = []
+        for iS, S in enumerate(index_levels['sigma']):
+            for iP, P in enumerate(index_levels['phi']):
+                for iK, K in enumerate(index_levels['kappa']):
+                    for isamp, samp in enumerate(index_levels['sample']):
+                        values = reducer.reduce(data[iS, iP, iK, 0, isamp])
+                        rows.append([S, P, K, stim, samp] + list(values))
+        result['candidate'] = pd.DataFrame(
+            rows, columns=keys + list(FallReducer.columns))
+
+    baseline()
+    candidate()
+    stats0 = result['baseline'].set_index(keys).sort_index()
+    stats1 = result['candidate'].set_index(keys).sort_index()
+    for column in FallReducer.columns:
+        x0 = np.asarray(stats0[column], dtype=float)
+        x1 = np.asarray(stats1[column], dtype=float)
+        same = np.isclose(x0, x1) | (np.isnan(x0) & np.isnan(x1))
+        if not same.all():
+            raise AssertionError(
+                "FallReducer's '%s' does not match the baseline" % column)
+
+    n = len(result['candidate'])
+    compare("reducers: %d conditions, %d objects" % (n, args.num_objs),
+            baseline, candidate, args.number, args.repeat,
+            per=n, unit="condition")
+
+
+def benchmark_batch(args):
+    """Compare simulating a stimulus' conditions one at a time against
+    simulating them in batches of copies of the tower, and check that
+    both give the same data."""
+    params = get_params(args.exp, args.tag)
+    sim_params = {
+        'physics': params['physics'],
+        'simulation': params['simulation'],
+    }
+
+    tasks = Tasks.create(params)
+    task = tasks[sorted(
+        x for x in tasks if tasks[x]['icpo'] == args.stim)[0]]
+    conditions = [
+        cond for cond in task['conditions']
+        if cond[3][0] < args.num_samples]
+    task = with_slices(
+        dict(task, conditions=conditions,
+             shape=[len(conditions)] + task['shape'][1:]),
+        params['noises'], params['forces'])
+
+    def run(batch_size):
+        runner = PersistentRunner(
+            sim_params, mp.Lock(), stream=True, batch_size=batch_size)
+        try:
+            start = time.time()
+            exitcode, result = runner.run(task, args.timeout)
+            elapsed = time.time() - start
+        finally:
+            runner.stop()
+        if result is None:
+            raise RuntimeError("batch size %d failed" % batch_size)
+        return elapsed, unpack(result['data'])
+
+    t0, data0 = run(1)
+    t1, data1 = run(args.batch_size)
+    error = np.abs(data0 - data1).max()
+
+    n = len(conditions)
+    print "batch: %d conditions of %s, batch size %d" % (
+        n, task['task_name'], args.batch_size)
+    print "  baseline : %10.2f ms/condition" % (t0 * 1e3 / n)
+    print "  candidate: %10.2f ms/condition" % (t1 * 1e3 / n)
+    print "  speedup  : %10.2fx" % (t0 / t1)
+    print "  max error: %10.2g" % error
+    if not error <= args.atol:
+        raise AssertionError("batched data does not match the baseline")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers()
+
+    read_parser = subparsers.add_parser(
+        "read",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Time reading the states of a tower's blocks.")
+    read_parser.add_argument(
+        "cpo",
+        help="Path to a cpo, relative to the cpo directory.")
+    read_parser.add_argument(
+        "-n", "--number",
+        default=10000,
+        type=int,
+        help="Number of calls per timing run.")
+    read_parser.add_argument(
+        "-r", "--repeat",
+        default=3,
+        type=int,
+        help="Number of timing runs.")
+    read_parser.set_defaults(func=benchmark_read)
+
+    params_parser = subparsers.add_parser(
+        "params",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Time fetching each condition's noise and force.")
+    params_parser.add_argument(
+        "--num-stims",
+        default=40,
+        dest="num_stims",
+        type=int,
+        help="Number of stimuli in the fake script.")
+    params_parser.add_argument(
+        "--num-samples",
+        default=100,
+        dest="num_samples",
+        type=int,
+        help="Number of samples in the fake script.")
+    params_parser.add_argument(
+        "--num-objs",
+        default=10,
+        dest="num_objs",
+        type=int,
+        help="Number of objects in the fake script.")
+    params_parser.add_argument(
+        "-n", "--number",
+        default=1,
+        type=int,
+        help="Number of calls per timing run.")
+    params_parser.add_argument(
+        "-r", "--repeat",
+        default=3,
+        type=int,
+        help="Number of timing runs.")
+    params_parser.set_defaults(func=benchmark_params)
+
+    reducers_parser = subparsers.add_parser(
+        "reducers",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help=("Time computing the fall statistics while simulating, and "
+              "check that they match those computed afterwards."))
+    reducers_parser.add_argument(
+        "--num-samples",
+        default=20,
+        dest="num_samples",
+        type=int,
+        help="Number of samples in the fake simulations.")
+    reducers_parser.add_argument(
+        "--num-objs",
+        default=10,
+        dest="num_objs",
+        type=int,
+        help="Number of objects in the fake simulations.")
+    reducers_parser.add_argument(
+        "-n", "--number",
+        default=1,
+        type=int,
+        help="Number of calls per timing run.")
+    reducers_parser.add_argument(
+        "-r", "--repeat",
+        default=3,
+        type=int,
+        help="Number of timing runs.")
+    reducers_parser.set_defaults(func=benchmark_reducers)
+
+    batch_parser = subparsers.add_parser(
+        "batch",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help=("Time simulating conditions in batches, and check that it "
+              "gives the same data as simulating them one at a time."))
+    batch_parser.add_argument(
+        "-e", "--exp",
+        required=True,
+        help="Experiment version.")
+    batch_parser.add_argument(
+        "-t", "--tag",
+        required=True,
+        help="Simulation tag. A short label for this simulation config.")
+    batch_parser.add_argument(
+        "--stim",
+        default=0,
+        type=int,
+        help="Index of the stimulus to simulate.")
+    batch_parser.add_argument(
+        "--num-samples",
+        default=2,
+        dest="num_samples",
+        type=int,
+        help="Number of samples of each condition to simulate.")
+    batch_parser.add_argument(
+        "-b", "--batch-size",
+        default=8,
+        dest="batch_size",
+        type=int,
+        help="Batch size to compare against a batch size of 1.")
+    batch_parser.add_argument(
+        "--atol",
+        default=1e-6,
+        type=float,
+        help="Largest acceptable difference from the unbatched data.")
+    batch_parser.add_argument(
+        "-T", "--timeout",
+        default=3600,
+        type=int,
+        help="Timeout (in seconds) for each run.")
+    batch_parser.set_defaults(func=benchmark_batch)
+
+    args = parser.parse_args()
+    args.func(args)
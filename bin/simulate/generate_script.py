@@ -3,6 +3,7 @@
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 from mass.sims.build import build
 from copy import deepcopy
+import json
 import numpy as np
 
 defaults = dict(
@@ -15,12 +16,25 @@ defaults = dict(
     # random seed
     seed=2938,
 
+    # simulate conditions without position noise or force (which are
+    # the same for every sample) only once
+    deduplicate=False,
+
     # path to the floor
     floor_path="floors/round-wooden-floor.cpo",
 
     # standard deviation of position noise
     sigmas=None,
 
+    # how to sample the position noise: 'iid', 'antithetic' (pairs of
+    # samples with opposite noise) or 'halton' (scrambled Halton
+    # sequence)
+    noise_sampling='iid',
+
+    # how to sample the force directions: 'iid', 'stratified', 'even'
+    # (evenly spaced) or 'halton' (scrambled van der Corput sequence)
+    force_sampling='iid',
+
     # force magnitude
     phis=None,
 
@@ -32,6 +46,17 @@ defaults = dict(
         0.6, 0.7, 0.8, 0.9, 1.0, 1.1, 1.2, 1.3
     ],
 
+    # if not None, first simulate every `coarse_step`th kappa, and then
+    # only the kappas in between neighbours whose outcomes differ
+    # (e.g. {'coarse_step': 4, 'movement_tolerance': 0.01})
+    kappa_refinement=None,
+
+    # if not None, simulate samples in waves of `wave_size`, and stop
+    # once the `confidence` interval of the proportion of blocks that
+    # fell is at most `max_width` wide (or `num_samples` is reached)
+    # (e.g. {'wave_size': 20, 'max_width': 0.1, 'confidence': 0.95})
+    sequential_sampling=None,
+
     # physics parameters
     physics={
         'gravity': [0.0, 0.0, -9.81],
@@ -51,6 +76,40 @@ defaults = dict(
 
         # how often (in steps) we record data
         'record_interval': 10,
+
+        # which of the recorded timesteps to keep in the data: 'all'
+        # (full trajectories, e.g. for time course analyses),
+        # 'endpoints' (pre-repel, post-repel and final states, which
+        # is all the fall queries need), or a list of indices into the
+        # recorded timesteps
+        'keep_timesteps': 'endpoints',
+
+        # how to store the data: None (float64 .npy arrays), or a
+        # compact, compressed .npz encoding with float32 positions and
+        # either 'quantized' (int16) or 'normalized' (float32)
+        # quaternions
+        'compact_storage': None,
+
+        # statistics to compute for each condition while simulating
+        # (e.g. 'fall', for which blocks fell, how far and in which
+        # direction), and whether to store the trajectories as well
+        'reducers': [],
+        'store_trajectories': True,
+
+        # blocks that move more than this (squared distance) fell
+        'fall_threshold': 0.0025,
+
+        # if not None, stop simulating once all the blocks' linear and
+        # angular speeds have been below this threshold for
+        # `rest_intervals` record intervals in a row
+        'rest_threshold': None,
+        'rest_intervals': 5,
+
+        # number of iterations of the constraint solver (None for
+        # Bullet's default), and whether bodies at rest may be put to
+        # sleep; see tune_physics.py
+        'solver_iterations': None,
+        'deactivation': False,
     },
 )
 
@@ -271,6 +330,20 @@ def make_options():
     return options
 
 
+def apply_physics_profile(params, profile_path):
+    """Use the physics settings recommended by tune_physics.py. The
+    record interval is scaled with the step size, so that the data is
+    still recorded at the same times."""
+    with open(profile_path, "r") as fh:
+        recommended = json.load(fh)['recommended']
+
+    simulation = params['simulation']
+    record_time = simulation['record_interval'] * simulation['step_size']
+    simulation.update(recommended)
+    simulation['record_interval'] = max(
+        1, int(round(record_time / simulation['step_size'])))
+
+
 def make_parser(exps, tags):
     parser = ArgumentParser(
         formatter_class=ArgumentDefaultsHelpFormatter)
@@ -290,6 +363,12 @@ def make_parser(exps, tags):
         action="store_true",
         default=False,
         help="Force script to be generated.")
+    parser.add_argument(
+        "--physics-profile",
+        default=None,
+        dest="physics_profile",
+        help=("Use the physics settings recommended in this profile "
+              "(as saved by tune_physics.py)."))
 
     return parser
 
@@ -308,5 +387,7 @@ if __name__ == "__main__":
             params.update(opts)
             params['exp'] = args.exp
             params['force'] = args.force
+            if args.physics_profile is not None:
+                apply_physics_profile(params, args.physics_profile)
             build(**params)
             break
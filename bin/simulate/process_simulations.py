@@ -1,12 +1,16 @@
 #!/usr/bin/env python
 
+from itertools import izip
 from path import path
-from snippets import datapackage as dpkg
 import argparse
+import datapackage as dpkg
 import numpy as np
+import pandas as pd
 import re
 
-from mass.sims.tasks import Tasks
+from mass.sims.reducers import REDUCERS, reduced_path
+from mass.sims.storage import ResultStore, load_data
+from mass.sims.tasks import Tasks, is_deterministic
 from mass.sims.utils import get_params
 from mass import DATA_PATH
 
@@ -15,8 +19,9 @@ def extract_key(taskname):
     return re.match(r"(\w+)_([a-zA-Z0-9\-]+)_(\d{2})", taskname).groups()
 
 
-def load(exp, tag):
-    params = get_params(exp, tag)
+def load_chunks(params, tag, time_idx):
+    """Load the data from the files saved by the clients for each task,
+    and put it together in the order of the script's index."""
     tasks = Tasks.load(params['tasks_path'])
 
     # first load in all the data
@@ -24,7 +29,7 @@ def load(exp, tag):
     conditions = {}
     for taskname in sorted(tasks.keys()):
         task = tasks[taskname]
-        data = np.load(task['data_path'])
+        data = load_data(task['data_path'])
         stim, _tag, chunk = extract_key(taskname)
         assert _tag == tag
         key = stim
@@ -45,9 +50,7 @@ def load(exp, tag):
         len(index_levels[x]) if x != 'stimulus' else 1
         for x in index_names])
 
-    stim_axis = index_names.index('stimulus')
     time_axis = index_names.index('timestep')
-    time_idx = [0, 1, -1]
 
     for key in data_by_key:
         # get the simulation indices, and sort by them, so we can
@@ -60,6 +63,169 @@ def load(exp, tag):
         all_data = np.vstack(data_by_key[key])[order].reshape(shape)
         data_by_key[key] = all_data.take(time_idx, axis=time_axis)
 
+    stim_axis = index_names.index('stimulus')
+    data = np.concatenate(
+        [data_by_key[str(path(key).namebase)]
+         for key in index_levels['stimulus']],
+        axis=stim_axis)
+
+    return data
+
+
+def scatter_chunks(params, time_idx):
+    """Load the data from the files saved by the clients for each task,
+    and put the data of each condition in its place in the script's
+    index. Unlike `load_chunks`, this doesn't need every condition to
+    have been simulated (as happens when the kappa grid is refined
+    adaptively): the data of those that haven't is NaN. Also returns
+    a boolean array (over the condition axes) of the conditions that
+    were simulated."""
+    tasks = Tasks.load(params['tasks_path'])
+
+    index_names = params['index_names']
+    index_levels = params['index_levels']
+    time_axis = index_names.index('timestep')
+    shape = [len(index_levels[x]) for x in index_names]
+    shape[time_axis] = len(time_idx)
+
+    data = np.empty(shape)
+    data.fill(np.nan)
+    simulated = np.zeros(shape[:time_axis], dtype=bool)
+
+    for taskname in sorted(tasks.keys()):
+        task = tasks[taskname]
+        # the task's data has the conditions along the first axis
+        chunk = load_data(task['data_path']).take(time_idx, axis=1)
+        icpo = task['icpo']
+        for cond, cond_data in izip(task['conditions'], chunk):
+            (iS, S), (iP, P), (iK, K), (isamp, samp) = cond
+            data[iS, iP, iK, icpo, isamp] = cond_data
+            simulated[iS, iP, iK, icpo, isamp] = True
+
+    return data, simulated
+
+
+def scheduled_conditions(params):
+    """A boolean array (over the condition axes) of the conditions that
+    the tasks file schedules for simulation."""
+    tasks = Tasks.load(params['tasks_path'])
+    index_names = params['index_names']
+    index_levels = params['index_levels']
+    time_axis = index_names.index('timestep')
+    shape = [len(index_levels[x]) for x in index_names[:time_axis]]
+
+    scheduled = np.zeros(shape, dtype=bool)
+    for task in tasks.itervalues():
+        icpo = task['icpo']
+        for cond in task['conditions']:
+            (iS, S), (iP, P), (iK, K), (isamp, samp) = cond
+            scheduled[iS, iP, iK, icpo, isamp] = True
+
+    return scheduled
+
+
+def broadcast_deterministic(params, data, simulated):
+    """Copy the first sample of each deterministic condition (see
+    `is_deterministic`), which is the only one that is simulated when
+    the script deduplicates them, to all of its samples."""
+    index_levels = params['index_levels']
+    for iS, S in enumerate(index_levels['sigma']):
+        for iP, P in enumerate(index_levels['phi']):
+            if not is_deterministic(S, P):
+                continue
+            # the remaining axes are kappa, stimulus and sample
+            for arr in (data, simulated):
+                arr[iS, iP, :, :, 1:] = arr[iS, iP, :, :, :1]
+
+
+def load_reduced(params, name):
+    """Put together the tables that the reducer `name` computed for
+    each task into one table, with a row for each condition. The rows
+    of deterministic conditions are copied to all of their samples,
+    if the script deduplicates them."""
+    tasks = Tasks.load(params['tasks_path'])
+    deduplicated = params.get('deduplicate', False)
+    samples = params['index_levels']['sample']
+
+    rows = []
+    for taskname in sorted(tasks.keys()):
+        task = tasks[taskname]
+        table = np.load(reduced_path(task['data_path'], name))
+        stim = str(path(task['cpo_path']).namebase)
+        for cond, values in izip(task['conditions'], table):
+            (iS, S), (iP, P), (iK, K), (isamp, samp) = cond
+            if deduplicated and is_deterministic(S, P):
+                copies = samples
+            else:
+                copies = [samp]
+            for samp in copies:
+                rows.append([S, P, K, samp, stim] + list(values))
+
+    columns = ['sigma', 'phi', 'kappa', 'sample', 'stimulus']
+    columns.extend(REDUCERS[name].columns)
+    return pd.DataFrame(rows, columns=columns)
+
+
+def load(exp, tag):
+    params = get_params(exp, tag)
+    index_names = params['index_names']
+    index_levels = params['index_levels']
+    time_idx = [0, 1, -1]
+
+    time_axis = index_names.index('timestep')
+    # with adaptive kappa refinement or sequential sampling, only some
+    # of the conditions are simulated
+    refined = (
+        'kappa_refinement' in params or 'sequential_sampling' in params)
+    # and deterministic conditions only have their first sample
+    deduplicated = params.get('deduplicate', False)
+    partial = refined or deduplicated
+
+    # if the clients streamed their data to the server, it is all in
+    # one place already
+    store = ResultStore(params['store_path'], params)
+    try:
+        store.open()
+    except IOError:
+        store = None
+
+    simulated = None
+    if store is not None and (partial or store.complete()):
+        data = store.data.take(time_idx, axis=time_axis)
+        if partial:
+            simulated = np.array(store.written)
+    elif partial:
+        data, simulated = scatter_chunks(params, time_idx)
+    else:
+        data = load_chunks(params, tag, time_idx)
+
+    # only the conditions that were never scheduled may be missing
+    if partial:
+        missing = scheduled_conditions(params) & ~simulated
+        if missing.any():
+            raise ValueError(
+                "%d of the scheduled conditions have not been simulated"
+                % missing.sum())
+        data[~simulated] = np.nan
+
+    if deduplicated:
+        broadcast_deterministic(params, data, simulated)
+    if not refined:
+        simulated = None
+
+    # the kappa and sample indices only have the kappas and samples
+    # that were simulated for at least one condition; which conditions
+    # were simulated is in `simulated`
+    if simulated is not None:
+        for name in ('kappa', 'sample'):
+            axis = index_names.index(name)
+            other_axes = tuple(
+                i for i in xrange(simulated.ndim) if i != axis)
+            idx = np.nonzero(simulated.any(axis=other_axes))[0]
+            data = data.take(idx, axis=axis)
+            simulated = simulated.take(idx, axis=axis)
+            index_levels[name] = [index_levels[name][i] for i in idx]
+
     step_size = params['simulation']['step_size']
     times = index_levels['timestep'][:1] + [
         str(int(x) * step_size)
@@ -70,21 +236,30 @@ def load(exp, tag):
     index_levels['stimulus'] = [
         str(path(x).namebase) for x in index_levels['stimulus']]
 
-    data = np.concatenate(
-        [data_by_key[key] for key in index_levels['stimulus']],
-        axis=stim_axis)
-
-    return params, data
+    return params, data, simulated
 
 
-def process(exp, tag, overwrite=False):
+def process(exp, tag, overwrite=False, compact=None):
     name = "%s_%s.dpkg" % (exp, tag)
     dp_path = DATA_PATH.joinpath("model-raw", name)
 
     if dp_path.exists() and not overwrite:
         return
 
-    params, data = load(exp, tag)
+    params = get_params(exp, tag)
+    store_trajectories = params['simulation'].get('store_trajectories', True)
+    reduced = dict(
+        (reducer, load_reduced(params, reducer))
+        for reducer in params['simulation'].get('reducers', []))
+
+    simulated = None
+    if store_trajectories:
+        params, data, simulated = load(exp, tag)
+    else:
+        params['index_levels']['stimulus'] = [
+            str(path(x).namebase) for x in params['index_levels']['stimulus']]
+    if compact is None:
+        compact = params['simulation'].get('compact_storage', None)
 
     forces = params['forces']
     noises = params['noises']
@@ -123,9 +298,31 @@ def process(exp, tag, overwrite=False):
         dp.add_contributor("Peter W. Battaglia", "pbatt@mit.edu")
         dp.add_contributor("Joshua B. Tenenbaum", "jbt@mit.edu")
 
-    dp.add_resource(dpkg.Resource(
-        name="simulations.npy", fmt="npy",
-        data=data, pth="./simulations.npy"))
+    # the resource keeps its name either way, so that it is loaded the
+    # same way regardless of how it is stored
+    if store_trajectories and compact:
+        sims = dpkg.Resource(
+            name="simulations.npy", fmt="npz",
+            data=data, pth="./simulations.npz")
+        sims['encoding'] = 'posquat'
+        sims['quaternions'] = compact
+        dp.add_resource(sims)
+    elif store_trajectories:
+        dp.add_resource(dpkg.Resource(
+            name="simulations.npy", fmt="npy",
+            data=data, pth="./simulations.npy"))
+
+    # which of the conditions in the index were actually simulated
+    if simulated is not None:
+        dp.add_resource(dpkg.Resource(
+            name="simulated.npy", fmt="npy",
+            data=simulated, pth="./simulated.npy"))
+
+    # the statistics that the simulations computed for each condition
+    for reducer in sorted(reduced):
+        dp.add_resource(dpkg.Resource(
+            name="%s.csv" % reducer, fmt="csv",
+            data=reduced[reducer], pth="./%s.csv" % reducer))
 
     dp.add_resource(dpkg.Resource(
         name="forces.npy", fmt="npy",
@@ -166,6 +363,13 @@ if __name__ == "__main__":
         action="store_true",
         default=False,
         help="Force datapackages to be generated.")
+    parser.add_argument(
+        "-c", "--compact",
+        choices=["quantized", "normalized"],
+        default=None,
+        help=("Store the simulations with float32 positions and quantized "
+              "or normalized quaternions, compressed (by default, use the "
+              "script's 'compact_storage' setting)."))
 
     args = parser.parse_args()
-    process(args.exp, args.tag, overwrite=args.force)
+    process(args.exp, args.tag, overwrite=args.force, compact=args.compact)
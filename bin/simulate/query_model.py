@@ -9,7 +9,7 @@ import logging
 import numpy as np
 import pandas as pd
 # Local
-from snippets import datapackage as dpkg
+import datapackage as dpkg
 from mass import DATA_PATH
 
 logger = logging.getLogger("mass.sims")
@@ -118,8 +118,12 @@ def process_model_fall(exp, tag, force=False):
     dp = dpkg.DataPackage.load(src_dp)
     dp.load_resources()
 
-    # compute the number of blocks that moved
-    resp = process_model_nmoved(dp)
+    # use the fall statistics that the simulations computed, if there
+    # are any, otherwise compute them from the trajectories
+    try:
+        resp = dp.load_resource('fall.csv')
+    except KeyError:
+        resp = process_model_nmoved(dp)
 
     # the destination datapackage already exists, so just load it and
     # update it
@@ -3,6 +3,7 @@
 import argparse
 from mass.sims.server import create_server_parser
 from mass.sims.client import create_client_parser
+from mass.sims.local import create_local_parser
 
 
 if __name__ == "__main__":
@@ -20,5 +21,10 @@ if __name__ == "__main__":
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     create_client_parser(client)
 
+    local = subparsers.add_parser(
+        "local",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    create_local_parser(local)
+
     args = parser.parse_args()
     args.func(args)
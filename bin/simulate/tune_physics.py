@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+"""Find the fastest physics settings that still agree with a tightly
+simulated reference. A few of a script's stimuli and samples are
+simulated with the reference settings, and then with every combination
+of coarser step sizes, substep sizes, numbers of solver iterations and
+deactivation policies. For each, we measure how long it takes, how
+often the number of blocks that fell agrees with the reference, and
+how far the final block positions are from the reference. The fastest
+settings within the given tolerances are saved as the recommended
+profile, which `generate_script.py --physics-profile` can use."""
+
+from itertools import product
+import argparse
+import json
+import logging
+import multiprocessing as mp
+import time
+import numpy as np
+
+from mass.sims.build import build_records
+from mass.sims.client import PersistentRunner
+from mass.sims.reducers import FallReducer
+from mass.sims.storage import unpack
+from mass.sims.tasks import Tasks, with_slices
+from mass.sims.utils import get_params
+
+logger = logging.getLogger("mass.sims.tune")
+
+SETTINGS = ('step_size', 'substep_size', 'solver_iterations', 'deactivation')
+
+
+def reference_tasks(params, num_stims, num_samples):
+    """The script's tasks for its first `num_stims` stimuli, with just
+    the conditions of their first `num_samples` samples."""
+    tasks = []
+    all_tasks = Tasks.create(params)
+    for task_name in sorted(all_tasks.keys()):
+        task = all_tasks[task_name]
+        if task['icpo'] >= num_stims:
+            continue
+        conditions = [
+            cond for cond in task['conditions'] if cond[3][0] < num_samples]
+        if not conditions:
+            continue
+        task = dict(task, conditions=conditions)
+        tasks.append(with_slices(
+            task, params['noises'], params['forces']))
+    return tasks
+
+
+def configure(params, tasks, settings):
+    """The physics and simulation parameters for `settings` (a dict
+    with a value for each of `SETTINGS`), and the tasks to run with
+    them. Records are taken the same (simulated) time apart as in the
+    script, and only the endpoints are kept."""
+    simulation = dict(params['simulation'])
+    simulation.update(settings)
+    record_time = (
+        params['simulation']['record_interval'] *
+        params['simulation']['step_size'])
+    simulation['record_interval'] = max(
+        1, int(round(record_time / settings['step_size'])))
+    simulation['reducers'] = [FallReducer.name]
+    simulation['store_trajectories'] = True
+    record_steps, simulation['n_substeps'] = build_records(simulation)
+
+    configured = []
+    for task in tasks:
+        task = dict(task)
+        task['record_intervals'] = list(np.diff(record_steps[1:]))
+        task['record_keep'] = [0, 1, len(record_steps) - 1]
+        task['shape'] = [len(task['conditions']), 3] + task['shape'][2:]
+        configured.append(task)
+
+    sim_params = {'physics': params['physics'], 'simulation': simulation}
+    return sim_params, configured
+
+
+def run(params, tasks, settings, timeout):
+    """Simulate the tasks with `settings`. Returns the wall time it
+    took, the final positions of the blocks in each condition, and the
+    number of blocks that fell in each condition."""
+    sim_params, tasks = configure(params, tasks, settings)
+    runner = PersistentRunner(sim_params, mp.Lock(), stream=True)
+    infell = FallReducer.columns.index('nfell')
+
+    final = []
+    nfell = []
+    start = time.time()
+    try:
+        for task in tasks:
+            exitcode, result = runner.run(task, timeout)
+            if result is None:
+                raise RuntimeError("task '%s' failed with %s" % (
+                    task['task_name'], settings))
+            data = unpack(result['data'])
+            final.append(data[:, -1, :, :3])
+            nfell.append(result['reduced'][FallReducer.name][:, infell])
+    finally:
+        runner.stop()
+    elapsed = time.time() - start
+
+    return elapsed, np.concatenate(final), np.concatenate(nfell)
+
+
+def compare(reference, candidate):
+    """How well the results of `candidate` agree with `reference` (both
+    as returned by `run`)."""
+    ref_time, ref_final, ref_nfell = reference
+    elapsed, final, nfell = candidate
+    error = np.sqrt(((final - ref_final) ** 2).sum(axis=-1))
+    return {
+        'seconds': elapsed,
+        'speedup': ref_time / elapsed,
+        'nfell_agreement': float((nfell == ref_nfell).mean()),
+        'median_position_error': float(np.median(error)),
+        'p95_position_error': float(np.percentile(error, 95)),
+    }
+
+
+def tune(exp, tag, reference, sweep, num_stims, num_samples, timeout,
+         min_agreement, max_error):
+    """Simulate the reference and every combination of the settings in
+    `sweep` (a dict with a list of values for each of `SETTINGS`), and
+    recommend the fastest settings whose agreement on the number of
+    blocks that fell is at least `min_agreement`, and whose 95th
+    percentile final position error is at most `max_error`."""
+    params = get_params(exp, tag)
+    tasks = reference_tasks(params, num_stims, num_samples)
+    n_conditions = sum(len(task['conditions']) for task in tasks)
+    logger.info("Tuning on %d conditions of %d stimuli",
+                n_conditions, len(tasks))
+
+    logger.info("Running reference: %s", reference)
+    ref = run(params, tasks, reference, timeout)
+    logger.info("Reference took %.1f seconds", ref[0])
+
+    results = []
+    for values in product(*[sweep[x] for x in SETTINGS]):
+        settings = dict(zip(SETTINGS, values))
+        if settings['substep_size'] > settings['step_size']:
+            continue
+        logger.info("Running %s", settings)
+        stats = compare(ref, run(params, tasks, settings, timeout))
+        stats['settings'] = settings
+        results.append(stats)
+        logger.info("  %.1fx faster, nfell agrees %.1f%%, position error "
+                    "%.4f (median) / %.4f (95%%)",
+                    stats['speedup'], 100 * stats['nfell_agreement'],
+                    stats['median_position_error'],
+                    stats['p95_position_error'])
+
+    acceptable = [
+        x for x in results
+        if x['nfell_agreement'] >= min_agreement and
+        x['p95_position_error'] <= max_error]
+    if acceptable:
+        best = min(acceptable, key=lambda x: x['seconds'])
+        recommended = best['settings']
+        logger.info("Recommended: %s (%.1fx faster than the reference)",
+                    recommended, best['speedup'])
+    else:
+        recommended = reference
+        logger.warning("No settings are within the tolerances, "
+                       "recommending the reference settings")
+
+    return {
+        'exp': exp,
+        'tag': tag,
+        'num_conditions': n_conditions,
+        'min_agreement': min_agreement,
+        'max_error': max_error,
+        'reference': {'settings': reference, 'seconds': ref[0]},
+        'results': results,
+        'recommended': recommended,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument(
+        "-e", "--exp",
+        required=True,
+        help="Experiment version.")
+    parser.add_argument(
+        "-t", "--tag",
+        required=True,
+        help="Simulation tag. A short label for this simulation config.")
+    parser.add_argument(
+        "-o", "--output",
+        default=None,
+        help=("Where to save the results and the recommended profile "
+              "(by default, physics_profile.json next to the tasks file)."))
+    parser.add_argument(
+        "--num-stims",
+        default=5,
+        dest="num_stims",
+        type=int,
+        help="Number of the script's stimuli to simulate.")
+    parser.add_argument(
+        "--num-samples",
+        default=10,
+        dest="num_samples",
+        type=int,
+        help="Number of samples of each condition to simulate.")
+    parser.add_argument(
+        "-T", "--timeout",
+        default=3600,
+        type=int,
+        help="Timeout (in seconds) for each task.")
+    parser.add_argument(
+        "--ref-step-size",
+        default=0.001,
+        dest="ref_step_size",
+        type=float,
+        help="Step size (in seconds) of the reference.")
+    parser.add_argument(
+        "--ref-substep-size",
+        default=0.0001,
+        dest="ref_substep_size",
+        type=float,
+        help="Substep size (in seconds) of the reference.")
+    parser.add_argument(
+        "--ref-iterations",
+        default=50,
+        dest="ref_iterations",
+        type=int,
+        help="Number of solver iterations of the reference.")
+    parser.add_argument(
+        "--step-sizes",
+        default=[0.005, 0.01, 0.02],
+        dest="step_sizes",
+        nargs="+",
+        type=float,
+        help="Step sizes (in seconds) to try.")
+    parser.add_argument(
+        "--substep-sizes",
+        default=[0.0005, 0.001, 0.002],
+        dest="substep_sizes",
+        nargs="+",
+        type=float,
+        help="Substep sizes (in seconds) to try.")
+    parser.add_argument(
+        "--solver-iterations",
+        default=[5, 10, 20],
+        dest="solver_iterations",
+        nargs="+",
+        type=int,
+        help="Numbers of solver iterations to try.")
+    parser.add_argument(
+        "--deactivation",
+        default=["off", "on"],
+        nargs="+",
+        choices=["off", "on"],
+        help="Whether to let resting bodies be put to sleep.")
+    parser.add_argument(
+        "--min-agreement",
+        default=0.95,
+        dest="min_agreement",
+        type=float,
+        help=("Smallest acceptable proportion of conditions in which the "
+              "number of blocks that fell agrees with the reference."))
+    parser.add_argument(
+        "--max-error",
+        default=0.05,
+        dest="max_error",
+        type=float,
+        help=("Largest acceptable 95th percentile distance between the "
+              "final block positions and those of the reference."))
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    reference = {
+        'step_size': args.ref_step_size,
+        'substep_size': args.ref_substep_size,
+        'solver_iterations': args.ref_iterations,
+        'deactivation': False,
+    }
+    sweep = {
+        'step_size': args.step_sizes,
+        'substep_size': args.substep_sizes,
+        'solver_iterations': args.solver_iterations,
+        'deactivation': [x == "on" for x in args.deactivation],
+    }
+    profile = tune(
+        args.exp, args.tag, reference, sweep,
+        num_stims=args.num_stims, num_samples=args.num_samples,
+        timeout=args.timeout, min_agreement=args.min_agreement,
+        max_error=args.max_error)
+
+    output = args.output
+    if output is None:
+        tasks_path = get_params(args.exp, args.tag)['tasks_path']
+        output = tasks_path.replace("tasks.json", "physics_profile.json")
+    with open(output, "w") as fh:
+        json.dump(profile, fh, indent=2)
+    logger.info("Saved profile to %s", output)
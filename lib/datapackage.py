@@ -21,6 +21,71 @@ def md5(data_path):
     return data_hash
 
 
+# quantized quaternion components are stored as int16, scaled by this;
+# the one int16 value that is left over stands in for NaN
+QUAT_SCALE = 32767
+QUAT_NAN = -32768
+
+
+def encode_posquat(data, quaternions='quantized'):
+    """Encode an array whose last axis is (x, y, z, q0, q1, q2, q3) into
+    a smaller form: the positions as float32, and the quaternions
+    normalized to unit length and either kept as float32
+    (`quaternions='normalized'`) or quantized to int16
+    (`quaternions='quantized'`). Returns a dictionary of arrays, which
+    can be decoded again with `decode_posquat`.
+
+    """
+    data = np.asarray(data)
+    pos = data[..., :3].astype('f4')
+    quat = data[..., 3:]
+
+    # normalize the quaternions, leaving all-zero ones (e.g. for data
+    # that was never written) alone
+    norm = np.sqrt((quat ** 2).sum(axis=-1))[..., None]
+    quat = quat / np.where(norm > 0, norm, 1)
+
+    if quaternions == 'normalized':
+        quat = quat.astype('f4')
+    elif quaternions == 'quantized':
+        nan = np.isnan(quat)
+        quat = np.round(np.where(nan, 0, quat) * QUAT_SCALE).astype('i2')
+        quat[nan] = QUAT_NAN
+    else:
+        raise ValueError("unsupported quaternion encoding: %s" % quaternions)
+
+    return {'pos': pos, 'quat': quat}
+
+
+def decode_posquat(arrays):
+    """Decode arrays that were encoded with `encode_posquat` into a
+    single float64 array."""
+    pos = np.asarray(arrays['pos'], dtype=float)
+    quat = np.asarray(arrays['quat'])
+    if quat.dtype.kind == 'i':
+        nan = quat == QUAT_NAN
+        quat = quat / float(QUAT_SCALE)
+        quat[nan] = np.nan
+    return np.concatenate([pos, np.asarray(quat, dtype=float)], axis=-1)
+
+
+def save_posquat(filename, data, quaternions='quantized'):
+    """Save a posquat array to a compressed .npz file in the compact
+    encoding of `encode_posquat`."""
+    # pass a file handle, so numpy doesn't change the extension
+    with open(filename, "wb") as fh:
+        np.savez_compressed(fh, **encode_posquat(data, quaternions))
+
+
+def load_posquat(filename):
+    """Load a posquat array saved by `save_posquat`."""
+    arrays = np.load(filename)
+    try:
+        return decode_posquat(arrays)
+    finally:
+        arrays.close()
+
+
 class DataPackage(dict):
 
     def __init__(self, name, licenses):
@@ -207,6 +272,10 @@ class Resource(dict):
                 json.dump(self.data, fh)
         elif self['format'] == 'npy':
             np.save(self.abspath, np.array(self.data))
+        elif self['format'] == 'npz' and self.get('encoding') == 'posquat':
+            save_posquat(
+                self.abspath, self.data,
+                quaternions=self.get('quaternions', 'quantized'))
         else:
             raise ValueError("unsupported format: %s" % self['format'])
 
@@ -233,6 +302,8 @@ class Resource(dict):
                 data = json.load(fh)
         elif self['format'] == 'npy':
             data = np.load(self.abspath, mmap_mode='c')
+        elif self['format'] == 'npz' and self.get('encoding') == 'posquat':
+            data = load_posquat(self.abspath)
         else:
             raise ValueError("unsupported format: %s" % self['format'])
 
@@ -5,6 +5,7 @@ import json
 import logging
 # External
 import numpy as np
+import scipy.stats
 # Scenesim
 from scenesim.objects.pso import PSO
 from scenesim.objects.sso import SSO
@@ -23,7 +24,54 @@ def get_objects(cpo_path):
     return objs
 
 
-def build_noises(sigmas, shape, rso):
+NOISE_SCHEMES = ('iid', 'antithetic', 'halton')
+FORCE_SCHEMES = ('iid', 'stratified', 'even', 'halton')
+
+
+def primes(n):
+    """The first `n` prime numbers."""
+    found = []
+    candidate = 2
+    while len(found) < n:
+        if all(candidate % p for p in found):
+            found.append(candidate)
+        candidate += 1
+    return found
+
+
+def scrambled_halton(n, dims, rso):
+    """The first `n` points of the Halton sequence in `dims` dimensions,
+    scrambled by randomly permuting the digits at each position of
+    each dimension. Returns an array of shape (n, dims), with values
+    in (0, 1).
+
+    Parameters
+    ----------
+    n : int
+        Number of points
+    dims : int
+        Number of dimensions
+    rso : np.random.RandomState
+        Random number generator
+
+    """
+    points = np.empty((n, dims))
+    for d, base in enumerate(primes(dims)):
+        # enough digits for double precision
+        n_digits = int(np.ceil(52 * np.log(2) / np.log(base)))
+        index = np.arange(n)
+        scale = 1.
+        x = np.zeros(n)
+        for k in xrange(n_digits):
+            scale /= base
+            x += rso.permutation(base)[index % base] * scale
+            index //= base
+        points[:, d] = x
+    eps = np.finfo(float).eps
+    return np.clip(points, eps, 1 - eps)
+
+
+def build_noises(sigmas, shape, rso, scheme='iid'):
     """Generate an array of position noise for each sigma.
 
     Parameters
@@ -31,36 +79,74 @@ def build_noises(sigmas, shape, rso):
     sigmas : 1d array-like
         List of standard deviations of the noise
     shape : tuple of ints
-        Shape to generating random noise in
+        Shape to generating random noise in, i.e. (n_stims, n_samples,
+        n_objs)
     rso : np.random.RandomState
         Random number generator
+    scheme : str
+        How to sample the noise: 'iid' draws every sample
+        independently; 'antithetic' draws pairs of samples whose noise
+        is the same but for the sign; 'halton' uses a scrambled Halton
+        sequence over the samples of each stimulus
 
     """
+    if scheme not in NOISE_SCHEMES:
+        raise ValueError("unknown noise sampling scheme: %s" % scheme)
+
+    n_stims, n_samples = shape[:2]
     # allocate the array
     noises = np.empty((len(sigmas),) + shape + (3,))
     # generate the values
     for i, sigma in enumerate(sigmas):
         if sigma == 0:
             noises[i] = 0
-        else:
+
+        elif scheme == 'iid':
             noises[i] = rso.normal(0, sigma, shape + (3,))
+
+        elif scheme == 'antithetic':
+            half = (n_stims, (n_samples + 1) // 2) + shape[2:] + (3,)
+            draws = rso.normal(0, sigma, half)
+            noises[i][:, 0::2] = draws
+            noises[i][:, 1::2] = -draws[:, :n_samples // 2]
+
+        elif scheme == 'halton':
+            dims = int(np.prod(shape[2:])) * 3
+            for istim in xrange(n_stims):
+                points = scrambled_halton(n_samples, dims, rso)
+                noises[i, istim] = sigma * scipy.stats.norm.ppf(
+                    points).reshape(shape[1:] + (3,))
+
     return noises
 
 
-def build_forces(phis, shape, rso):
-    """Generate an array of force noise for each phi. Angles are chosen
-    evenly distributed around the circle.
+def build_forces(phis, shape, rso, scheme='iid'):
+    """Generate an array of force noise for each phi. The direction of
+    the force is the same for every phi.
 
     Parameters
     ----------
     phi : 1d array-like
         List of force magnitudes
     shape : tuple of ints
-        Shape to generating random noise in
+        Shape to generating random noise in, i.e. (n_stims, n_samples)
     rso : np.random.RandomState
         Random number generator
+    scheme : str
+        How to sample the directions: 'iid' draws an integer angle for
+        every sample independently; the other schemes spread the
+        angles over the circle (in radians, which is how `get_force`
+        takes them) for each stimulus: 'stratified' draws one angle
+        from each of `n_samples` equal arcs, 'even' spaces them evenly
+        from a random offset, and 'halton' uses a scrambled van der
+        Corput sequence, so that any first few samples are spread out,
+        too. The stratified and even angles are shuffled across
+        samples.
 
     """
+    if scheme not in FORCE_SCHEMES:
+        raise ValueError("unknown force sampling scheme: %s" % scheme)
+
     # create the datatype we'll be using
     dtype = np.dtype([
         ('dir', 'f8'),
@@ -68,8 +154,28 @@ def build_forces(phis, shape, rso):
     ])
     # allocate the array
     forces = np.empty((len(phis),) + shape, dtype=dtype)
+
     # generate the random directions
-    forces['dir'] = rso.randint(0, 360, shape)
+    if scheme == 'iid':
+        forces['dir'] = rso.randint(0, 360, shape)
+
+    else:
+        n_stims, n_samples = shape
+        arc = 2 * np.pi / n_samples
+        dirs = np.empty(shape)
+        for istim in xrange(n_stims):
+            if scheme == 'stratified':
+                angles = (np.arange(n_samples) + rso.uniform(
+                    size=n_samples)) * arc
+                dirs[istim] = rso.permutation(angles)
+            elif scheme == 'even':
+                angles = (np.arange(n_samples) + rso.uniform()) * arc
+                dirs[istim] = rso.permutation(angles)
+            elif scheme == 'halton':
+                points = scrambled_halton(n_samples, 1, rso)
+                dirs[istim] = 2 * np.pi * points[:, 0]
+        forces['dir'] = dirs
+
     forces['mag'] = np.array(phis)[[slice(None)] + [None] * len(shape)]
     return forces
 
@@ -98,6 +204,86 @@ def build_records(params):
     return ["pre-repel"] + record_steps, n_substeps
 
 
+def select_records(n_records, keep):
+    """Choose which of the recorded timesteps to keep in the data.
+
+    Parameters
+    ----------
+    n_records : int
+        Number of recorded timesteps (including "pre-repel")
+    keep : str or list of ints
+        Either 'all' (the full trajectories), 'endpoints' (the states
+        before and after the position noise, and the final state,
+        which is all that the fall queries use), or a list of indices
+        into the recorded timesteps
+
+    """
+    if keep == 'all':
+        keep = range(n_records)
+    elif keep == 'endpoints':
+        keep = [0, 1, n_records - 1]
+    keep = sorted(set(int(i) % n_records for i in keep))
+
+    # processing the simulations relies on these
+    for i in (0, 1, n_records - 1):
+        if i not in keep:
+            raise ValueError(
+                "recorded timestep %d must be kept: %s" % (i, keep))
+
+    return keep
+
+
+def build_refinement(kappas, refinement):
+    """Settings for adaptive refinement of the kappa grid (see
+    `Tasks.refine`).
+
+    Parameters
+    ----------
+    kappas : list
+        The full kappa grid
+    refinement : dict
+        `coarse_step` is the spacing (in grid points) of the kappas
+        that are simulated first; the first and last kappa are always
+        included. Neighbouring kappas whose total movements differ by
+        more than `movement_tolerance` (or whose number of fallen
+        blocks differ) are refined.
+
+    """
+    n_kappas = len(kappas)
+    step = int(refinement.get('coarse_step', 4))
+    coarse = sorted(set(range(0, n_kappas, step)) | set([n_kappas - 1]))
+    return {
+        'coarse': coarse,
+        'movement_tolerance': float(
+            refinement.get('movement_tolerance', 0.01)),
+    }
+
+
+def build_sequential(num_samples, sampling):
+    """Settings for sequential sampling (see `Tasks.next_wave`).
+
+    Parameters
+    ----------
+    num_samples : int
+        The most samples to simulate for any condition
+    sampling : dict
+        Samples are simulated in waves of `wave_size`, until the
+        `confidence` interval of the proportion of blocks that fell is
+        at most `max_width` wide.
+
+    """
+    wave_size = int(sampling.get('wave_size', 20))
+    if not 0 < wave_size <= num_samples:
+        raise ValueError("wave size must be between 1 and %d" % num_samples)
+    confidence = float(sampling.get('confidence', 0.95))
+    return {
+        'wave_size': wave_size,
+        'max_width': float(sampling.get('max_width', 0.1)),
+        'confidence': confidence,
+        'z': float(scipy.stats.norm.ppf(0.5 + confidence / 2.)),
+    }
+
+
 def build(exp, tag, force, **params):
     """Create a simulation script."""
 
@@ -138,13 +324,21 @@ def build(exp, tag, force, **params):
     n_objs = len(objs[0])
 
     # Generate arrays of perceptual and force noise
+    noise_scheme = params.get('noise_sampling', 'iid')
+    force_scheme = params.get('force_sampling', 'iid')
     noises = build_noises(
-        params['sigmas'], (n_stims, n_samples, n_objs), rso)
+        params['sigmas'], (n_stims, n_samples, n_objs), rso,
+        scheme=noise_scheme)
     forces = build_forces(
-        params['phis'], (n_stims, n_samples), rso)
+        params['phis'], (n_stims, n_samples), rso,
+        scheme=force_scheme)
 
-    # The timesteps when we will actually be recording
+    # The timesteps when we will actually be recording, and the ones
+    # that we keep
     record_steps, n_substeps = build_records(params['simulation'])
+    record_keep = select_records(
+        len(record_steps),
+        params['simulation'].get('keep_timesteps', 'all'))
 
     # Put it all together in a big dictionary...
     script = {}
@@ -165,8 +359,40 @@ def build(exp, tag, force, **params):
     script['physics'] = params['physics']
     script['simulation'] = params['simulation']
     script['simulation']['n_substeps'] = n_substeps
+    script['record_steps'] = record_steps
     script['max_chunk_size'] = params['max_chunk_size']
 
+    # only simulate one sample of the conditions without noise or force
+    script['deduplicate'] = bool(params.get('deduplicate', False))
+
+    # how the noise and forces were generated
+    script['sampling'] = {
+        'noise': noise_scheme,
+        'force': force_scheme,
+        'seed': params['seed'],
+        'generator': 'numpy.random.RandomState',
+        'numpy_version': np.__version__,
+    }
+
+    # adaptive refinement of the kappa grid, and sequential sampling
+    if params.get('kappa_refinement', None):
+        script['kappa_refinement'] = build_refinement(
+            params['kappas'], params['kappa_refinement'])
+    if params.get('sequential_sampling', None):
+        script['sequential_sampling'] = build_sequential(
+            n_samples, params['sequential_sampling'])
+        # keep antithetic pairs in the same wave
+        wave_size = script['sequential_sampling']['wave_size']
+        if noise_scheme == 'antithetic' and wave_size % 2 != 0:
+            raise ValueError(
+                "wave size must be even with antithetic noise")
+
+    # both of which are based on the fall statistics of each condition
+    if 'kappa_refinement' in script or 'sequential_sampling' in script:
+        reducers = script['simulation'].setdefault('reducers', [])
+        if 'fall' not in reducers:
+            reducers.append('fall')
+
     # the index names for the data we'll be saving out
     script['index_names'] = [
         "sigma",
@@ -187,7 +413,7 @@ def build(exp, tag, force, **params):
         'stimulus': [str(x.name) for x in cpo_paths],
         'sample': range(n_samples),
         'object': objs[0],
-        'timestep': record_steps,
+        'timestep': [record_steps[i] for i in record_keep],
         'posquat': ['x', 'y', 'z', 'q0', 'q1', 'q2', 'q3'],
     }
 
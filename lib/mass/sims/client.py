@@ -1,10 +1,15 @@
+import os
+import socket
 import sys
+import time
+import Queue
 import multiprocessing as mp
 import logging
-from threading import Thread, current_thread
+from collections import Counter
+from threading import Event, Lock, Thread, current_thread
 from utils import parse_address
 from server import ServerManager
-from simulation import Simulation
+from simulation import Simulation, SimulationWorker, MAX_BATCH_SIZE
 
 logger = logging.getLogger("mass.sims.client")
 
@@ -19,102 +24,440 @@ class ProcessError(Exception):
         del proc
 
 
-def worker_thread(mgr, info_lock, save=False, max_tries=3, timeout=1e5):
+class IsolatedRunner(object):
+    """Runs each task in its own, fresh `Simulation` process."""
+
+    def __init__(self, params, info_lock, save=False, batch_size=1,
+                 stream=False, compress=False, profile=False):
+        self.params = params
+        self.info_lock = info_lock
+        self.save = save
+        self.batch_size = batch_size
+        self.stream = stream
+        self.compress = compress
+        self.profile = profile
+
+    def run(self, task, timeout):
+        """Run `task`, and return the exit code of the process that ran
+        it (or None if it timed out), along with the message that the
+        process sent back about the task (or None, if it failed)."""
+        conn, child_conn = mp.Pipe(duplex=False)
+        job = Simulation(
+            task, self.params, self.info_lock,
+            save=self.save, batch_size=self.batch_size,
+            stream=self.stream, compress=self.compress, conn=child_conn,
+            profile=self.profile)
+        logger.info("Starting task '%s' (%s)", task['task_name'], job.name)
+        job.start()
+        # close our copy of the child's end, so that we get an EOF if
+        # the process dies
+        child_conn.close()
+
+        # Wait for the result rather than for the process to exit: the
+        # process can't exit until we have read everything it sent.
+        result = None
+        if conn.poll(timeout):
+            try:
+                result = conn.recv()
+            except EOFError:
+                pass
+            job.join()
+        conn.close()
 
-    params = mgr.get_params()
-    task_queue = mgr.get_task_queue()
+        # the process timed out
+        if job.is_alive():
+            job.terminate()
+            job.join()
+            return None, None
+
+        return job.exitcode, result
+
+    def stop(self):
+        pass
+
+
+class PersistentRunner(IsolatedRunner):
+    """Runs tasks on a long-lived `SimulationWorker` process, which
+    keeps its physics world between tasks. If the worker times out or
+    crashes, it is thrown away and a new one is started for the next
+    task.
+
+    """
+
+    def __init__(self, params, info_lock, save=False, batch_size=1,
+                 stream=False, compress=False, profile=False):
+        super(PersistentRunner, self).__init__(
+            params, info_lock, save=save, batch_size=batch_size,
+            stream=stream, compress=compress, profile=profile)
+        self.worker = None
+        self.conn = None
+
+    def start(self):
+        self.conn, child_conn = mp.Pipe()
+        self.worker = SimulationWorker(
+            child_conn, self.params, self.info_lock,
+            save=self.save, batch_size=self.batch_size,
+            stream=self.stream, compress=self.compress,
+            profile=self.profile)
+        self.worker.start()
+        # close our copy of the child's end, so that we get an EOF if
+        # the worker dies
+        child_conn.close()
+
+    def kill(self):
+        self.worker.terminate()
+        self.worker.join()
+        self.conn.close()
+        self.worker = None
+        self.conn = None
+
+    def run(self, task, timeout):
+        if self.worker is None or not self.worker.is_alive():
+            self.start()
+
+        logger.info("Starting task '%s' (%s)",
+                    task['task_name'], self.worker.name)
+        self.conn.send(task)
+
+        # the worker timed out
+        if not self.conn.poll(timeout):
+            self.kill()
+            return None, None
+
+        try:
+            result = self.conn.recv()
+        except EOFError:
+            # the worker died
+            self.worker.join()
+            exitcode = self.worker.exitcode
+            self.conn.close()
+            self.worker = None
+            self.conn = None
+            return exitcode, None
+
+        return 0, result
+
+    def stop(self):
+        if self.worker is None:
+            return
+        try:
+            self.conn.send(None)
+        except IOError:
+            pass
+        self.worker.join()
+        self.conn.close()
+        self.worker = None
+        self.conn = None
+
+
+class HeldTasks(object):
+    """The names of the tasks that this client currently holds (i.e.,
+    has taken off the queue and not yet reported back on), shared by
+    all the worker threads."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.names = Counter()
+
+    def add(self, task_name):
+        with self.lock:
+            self.names[task_name] += 1
+
+    def remove(self, task_name):
+        with self.lock:
+            self.names[task_name] -= 1
+            if self.names[task_name] <= 0:
+                del self.names[task_name]
+
+    def list(self):
+        with self.lock:
+            return sorted(self.names)
+
+    def total(self):
+        with self.lock:
+            return sum(self.names.values())
+
+
+class Reporter(object):
+    """Collects the reports that a client's threads make about their
+    tasks, and sends them to the server in batches, rather than making
+    a round trip to the server for every report."""
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.reports = Queue.Queue()
+
+    def report(self, status, task, **info):
+        info['status'] = status
+        info['task_name'] = task['task_name']
+        info['client'] = self.client_id
+        self.reports.put(info)
+
+    def flush(self, done_queue):
+        batch = []
+        while True:
+            try:
+                batch.append(self.reports.get_nowait())
+            except Queue.Empty:
+                break
+        if batch:
+            done_queue.put({'status': 'batch', 'reports': batch})
+
+    def run(self, mgr, interval, stop):
+        """Send the reports every `interval` seconds until `stop` is
+        set, and then send whatever is left."""
+        done_queue = mgr.get_done_queue()
+        while True:
+            stopping = stop.wait(interval)
+            try:
+                self.flush(done_queue)
+            except (EOFError, IOError):
+                break
+            if stopping:
+                break
+
+
+def heartbeat_thread(mgr, held, client_id, n_workers, interval, stop):
+    """Periodically renew the server's leases on all the tasks that
+    this client holds, and tell the server how many of its `n_workers`
+    have nothing to do (which is when the server may hand out
+    duplicates of slow tasks), until `stop` is set."""
     done_queue = mgr.get_done_queue()
+    while not stop.wait(interval):
+        try:
+            done_queue.put({
+                'status': 'heartbeat',
+                'task_names': held.list(),
+                'idle': max(0, n_workers - held.total()),
+                'client': client_id,
+            })
+        except (EOFError, IOError):
+            break
 
-    def retry(task):
-        task_queue.put(task)
-        task_queue.task_done()
 
-    def finish(task):
-        done_queue.put(task["task_name"])
-        task_queue.task_done()
+def release(task_queue, reporter, held, task, reason=None):
+    """Give up a task that we hold, and put it back on the queue. The
+    `reason` (e.g. 'timeout' or 'error') is passed on to the server."""
+    held.remove(task['task_name'])
+    # give up our lease, so the server doesn't also requeue it
+    reporter.report('released', task, reason=reason)
+    task_queue.put(task)
 
-    while True:
+
+def prefetch_thread(mgr, prefetched, held, reporter, poll_interval,
+                    stop, closed):
+    """Keep the `prefetched` queue topped up with tasks from the
+    server, so that the worker threads never have to wait on the
+    server for their next task. Prefetched tasks are leased as soon as
+    they are fetched. Sets `closed` once the server has gone away or
+    `stop` has been set."""
+    task_queue = mgr.get_task_queue()
+    while not stop.is_set():
+        # Keep waiting for tasks until the server shuts down: even when
+        # the queue is empty, the server may still queue retries or
+        # duplicates of slow tasks.
         try:
-            if task_queue.empty():
-                break
+            task = task_queue.get(timeout=poll_interval)
+        except Queue.Empty:
+            continue
         except (EOFError, IOError):
             break
 
-        task = task_queue.get()
+        held.add(task['task_name'])
+        reporter.report('fetched', task)
+
+        while not stop.is_set():
+            try:
+                prefetched.put(task, timeout=poll_interval)
+                break
+            except Queue.Full:
+                continue
+        else:
+            try:
+                release(task_queue, reporter, held, task)
+            except (EOFError, IOError):
+                pass
+
+    closed.set()
+
+
+def worker_thread(mgr, info_lock, prefetched, reporter, held, closed,
+                  save=False, max_tries=3, timeout=1e5, persistent=False,
+                  batch_size=1, poll_interval=5, stream=False,
+                  compress=False, profile=False):
+
+    # the physics and simulation parameters come with each task
+    params = None
+    task_queue = mgr.get_task_queue()
+
+    def retry(task, reason):
+        release(task_queue, reporter, held, task, reason=reason)
+
+    def finish(task, elapsed, result):
+        held.remove(task['task_name'])
+        # the data (if we are streaming it) and the reducers' tables
+        # go along with the report, so the server gets them at the same
+        # time as it learns that the task is done
+        reporter.report('done', task,
+                        elapsed=elapsed,
+                        n_conditions=len(task['conditions']),
+                        sim_time=result['sim_time'],
+                        timing=result['timing'],
+                        data=result['data'],
+                        reduced=result.get('reduced'))
+
+    def fail(task, reason):
+        held.remove(task['task_name'])
+        reporter.report('failed', task, reason=reason)
+
+    runner_kwargs = dict(
+        save=save, batch_size=batch_size, stream=stream, compress=compress,
+        profile=profile)
+    if persistent:
+        runner = PersistentRunner(params, info_lock, **runner_kwargs)
+    else:
+        runner = IsolatedRunner(params, info_lock, **runner_kwargs)
+
+    while True:
+        # Take the next prefetched task, until the prefetcher has
+        # stopped and there are none left.
+        try:
+            task = prefetched.get(timeout=poll_interval)
+        except Queue.Empty:
+            if closed.is_set():
+                break
+            continue
+
         task_name = task['task_name']
-        job = Simulation(task, params, info_lock, save=save)
-        logger.info("Starting task '%s' (%s)", task_name, job.name)
-        job.start()
-        job.join(timeout=timeout)
+        reporter.report('started', task)
 
-        # the thread timed out
-        if job.is_alive():
-            logger.warning("Timeout for task '%s' (%s)", task_name, job.name)
-            job.terminate()
-            job.join()
-            error = True
+        start_time = time.time()
+        exitcode, result = runner.run(task, timeout)
+        elapsed = time.time() - start_time
 
-        elif job.exitcode == 100:
+        # the process timed out
+        if exitcode is None:
+            logger.warning("Timeout for task '%s'", task_name)
+            error = 'timeout'
+
+        elif exitcode == 100:
             logger.warning("Process interrupted, exiting.")
-            retry(task)
+            try:
+                retry(task, 'interrupted')
+            except (EOFError, IOError):
+                pass
             break
 
         # there was an error
-        elif job.exitcode != 0:
-            logger.error("Task '%s' (%s) exited with code %d",
-                         task_name, job.name, job.exitcode)
-            error = True
+        elif exitcode != 0:
+            logger.error("Task '%s' exited with code %d", task_name, exitcode)
+            error = 'error'
 
         else:
-            logger.info("Task '%s' (%s) complete", task_name, job.name)
-            error = False
-
-        if error:
-            task["num_tries"] += 1
-            if task["num_tries"] >= max_tries:
-                logger.error("%d failed attempts at task '%s'",
-                             task["num_tries"], task_name)
-                task_queue.task_done()
-                break
+            logger.info("Task '%s' complete", task_name)
+            error = None
+
+        try:
+            if error:
+                task["num_tries"] += 1
+                if task["num_tries"] >= max_tries:
+                    logger.error("%d failed attempts at task '%s'",
+                                 task["num_tries"], task_name)
+                    fail(task, error)
+                    break
+
+                else:
+                    logger.warning("Retrying task '%s' (%d/%d)",
+                                   task_name, task["num_tries"], max_tries)
+                    retry(task, error)
 
             else:
-                logger.warning("Retrying task '%s' (%d/%d)",
-                               task_name, task["num_tries"], max_tries)
-                retry(task)
+                finish(task, elapsed, result)
 
-        else:
-            finish(task)
+        # the server has already shut down
+        except (EOFError, IOError):
+            break
 
+    runner.stop()
     logger.info("Ending thread: %s", current_thread())
     sys.exit(0)
 
 
-def run_client(**kwargs):
-    """Run the simulation client manager."""
+def run_workers(mgr, **kwargs):
+    """Run simulation workers on the tasks of the manager `mgr`, until
+    the manager goes away or the `stop` event (if given) is set."""
 
     save = kwargs.get("save", False)
     timeout = kwargs.get("timeout", 310)
-    address = kwargs.get("address", ("127.0.0.1", 50000))
-    authkey = kwargs.get("authkey", None)
     n_procs = kwargs.get("n_procs", mp.cpu_count())
     max_tries = kwargs.get("max_tries", 3)
-
-    # Job-specific parameters.
-    kwargs = dict(save=save)
-
-    # Connect to the server manager
-    ServerManager.register_shared(with_callable=False)
-    mgr = ServerManager(address=address, authkey=authkey)
-    mgr.connect()
+    persistent = kwargs.get("persistent", False)
+    batch_size = kwargs.get("batch_size", 1)
+    heartbeat = kwargs.get("heartbeat", 15)
+    stream = kwargs.get("stream", False)
+    compress = kwargs.get("compress", False)
+    prefetch = kwargs.get("prefetch", 1)
+    report_interval = kwargs.get("report_interval", 1)
+    profile = kwargs.get("profile", False)
+    stop = kwargs.get("stop", None) or Event()
+
+    if prefetch < 1:
+        raise ValueError("prefetch must be at least 1")
+
+    # The tasks held by this client (running or prefetched), and how
+    # they are identified to the server.
+    held = HeldTasks()
+    client_id = "%s:%d" % (socket.gethostname(), os.getpid())
+    reporter = Reporter(client_id)
+    prefetched = Queue.Queue(maxsize=prefetch)
 
     # create a lock for printing information
     info_lock = mp.Lock()
 
+    # Start sending reports to the server.
+    stop_reports = Event()
+    reports = Thread(
+        name="Reporter",
+        target=reporter.run,
+        args=(mgr, report_interval, stop_reports))
+    reports.daemon = True
+    reports.start()
+
+    # Keep the leases on our tasks alive.
+    heartbeat_kwargs = {
+        'held': held,
+        'client_id': client_id,
+        'n_workers': n_procs,
+        'interval': heartbeat,
+        'stop': stop
+    }
+    heartbeat = Thread(
+        name="Heartbeat",
+        target=heartbeat_thread,
+        args=(mgr,),
+        kwargs=heartbeat_kwargs)
+    heartbeat.daemon = True
+    heartbeat.start()
+
+    # Fetch tasks ahead of the workers.
+    closed = Event()
+    fetcher = Thread(
+        name="Prefetcher",
+        target=prefetch_thread,
+        args=(mgr, prefetched, held, reporter, 1, stop, closed))
+    fetcher.daemon = True
+    fetcher.start()
+
     # Set up params and task parameters.
     worker_kwargs = {
         'timeout': timeout,
         'save': save,
-        'max_tries': max_tries
+        'max_tries': max_tries,
+        'persistent': persistent,
+        'batch_size': batch_size,
+        'stream': stream,
+        'compress': compress,
+        'profile': profile
     }
 
     logger.info("Starting processes...")
@@ -123,7 +466,7 @@ def run_client(**kwargs):
         thread = Thread(
             name="Thread_%02d" % ithread,
             target=worker_thread,
-            args=(mgr, info_lock),
+            args=(mgr, info_lock, prefetched, reporter, held, closed),
             kwargs=worker_kwargs)
         threads.append(thread)
         thread.start()
@@ -132,6 +475,38 @@ def run_client(**kwargs):
     for thread in threads:
         thread.join()
 
+    # Stop fetching, and give back the tasks that nobody got to.
+    stop.set()
+    fetcher.join()
+    heartbeat.join()
+    task_queue = mgr.get_task_queue()
+    while True:
+        try:
+            task = prefetched.get_nowait()
+        except Queue.Empty:
+            break
+        try:
+            release(task_queue, reporter, held, task)
+        except (EOFError, IOError):
+            break
+
+    stop_reports.set()
+    reports.join()
+
+
+def run_client(**kwargs):
+    """Run the simulation client manager."""
+
+    address = kwargs.get("address", ("127.0.0.1", 50000))
+    authkey = kwargs.get("authkey", None)
+
+    # Connect to the server manager
+    ServerManager.register_shared(with_callable=False)
+    mgr = ServerManager(address=address, authkey=authkey)
+    mgr.connect()
+
+    run_workers(mgr, **kwargs)
+
     logger.info("Jobs complete.")
     sys.exit(0)
 
@@ -143,7 +518,15 @@ def parse_and_run_client(args):
         'address': args.address,
         'authkey': args.authkey,
         'n_procs': args.num_procs,
-        'max_tries': args.max_tries
+        'max_tries': args.max_tries,
+        'persistent': args.persistent,
+        'batch_size': args.batch_size,
+        'heartbeat': args.heartbeat,
+        'stream': args.stream,
+        'compress': args.compress,
+        'prefetch': args.prefetch,
+        'report_interval': args.report_interval,
+        'profile': args.profile
     }
     run_client(**kwargs)
 
@@ -179,4 +562,50 @@ def create_client_parser(parser):
         dest="max_tries",
         type=int,
         help="Number of times to try running a task.")
+    parser.add_argument(
+        "-p", "--persistent",
+        action="store_true",
+        help=("Keep one long-lived simulation process per worker, instead "
+              "of starting a new process for every task."))
+    parser.add_argument(
+        "-b", "--batch-size",
+        default=1,
+        dest="batch_size",
+        type=int,
+        help=("Maximum number of conditions (differing only in kappa) to "
+              "simulate together in one physics world, up to %d." %
+              MAX_BATCH_SIZE))
+    parser.add_argument(
+        "--heartbeat",
+        default=15,
+        type=float,
+        help=("Interval (in seconds) at which to renew the leases on "
+              "running tasks. Must be shorter than the server's lease."))
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help=("Send the data of each task back to the server, instead of "
+              "(or as well as, with -s) saving it to a shared filesystem."))
+    parser.add_argument(
+        "-z", "--compress",
+        action="store_true",
+        help="Compress the data sent back with --stream.")
+    parser.add_argument(
+        "--prefetch",
+        default=1,
+        type=int,
+        help=("Number of tasks to fetch from the server ahead of time, so "
+              "that workers don't wait on the server between tasks."))
+    parser.add_argument(
+        "--report-interval",
+        default=1,
+        dest="report_interval",
+        type=float,
+        help=("Interval (in seconds) at which reports on finished tasks "
+              "are sent to the server, batched together."))
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=("Time each phase of the simulations, and send the timings "
+              "to the server (and save them next to the data, with -s)."))
     parser.set_defaults(func=parse_and_run_client)
@@ -0,0 +1,157 @@
+import sys
+import Queue
+import multiprocessing as mp
+import logging
+from threading import Event, Thread
+from server import Experiment, TaskManager
+from client import run_workers
+from simulation import MAX_BATCH_SIZE
+
+logger = logging.getLogger("mass.sims.local")
+
+
+class LocalManager(TaskManager):
+    """Runs the tasks of simulation scripts on this machine only. The
+    workers are threads of the same process as the manager, so the
+    queues are shared with them directly rather than through a
+    server."""
+
+    def __init__(self):
+        self.task_queue = Queue.Queue()
+        self.done_queue = Queue.Queue()
+
+    def get_task_queue(self):
+        return self.task_queue
+
+    def get_done_queue(self):
+        return self.done_queue
+
+
+def run_local(exp, tag, **kwargs):
+    """Run all the simulations of a script on this machine, without
+    starting a server and clients."""
+
+    force = kwargs.get("force", False)
+    target_duration = kwargs.get("target_duration", None)
+    timeout = kwargs.get("timeout", 310)
+    n_procs = kwargs.get("n_procs", mp.cpu_count())
+    max_tries = kwargs.get("max_tries", 3)
+    persistent = kwargs.get("persistent", False)
+    batch_size = kwargs.get("batch_size", 1)
+    profile = kwargs.get("profile", False)
+
+    # Set up parameters and task data.
+    experiment = Experiment(exp, tag)
+    experiment.load_tasks(
+        force, target_duration=target_duration, timeout=timeout)
+    mgr = LocalManager()
+
+    # Run the workers in the background until all the tasks are done.
+    stop = Event()
+    worker_kwargs = {
+        'save': True,
+        'timeout': timeout,
+        'n_procs': n_procs,
+        'max_tries': max_tries,
+        'persistent': persistent,
+        'batch_size': batch_size,
+        'profile': profile,
+        'stop': stop
+    }
+    workers = Thread(
+        name="Workers",
+        target=run_workers,
+        args=(mgr,),
+        kwargs=worker_kwargs)
+    workers.start()
+
+    # There are no other machines to hand duplicates of slow tasks to,
+    # so don't speculate.
+    try:
+        failed = mgr.manage_tasks(
+            [experiment], speculate=False, poll_interval=1,
+            queue_depth=2 * n_procs,
+            metrics_file=experiment.params["metrics_path"])
+    finally:
+        stop.set()
+        workers.join()
+
+    if failed:
+        sys.exit(1)
+
+    logger.info("Jobs complete.")
+    sys.exit(0)
+
+
+def parse_and_run_local(args):
+    exp = args.exp
+    tag = args.tag
+    kwargs = {
+        'force': args.force,
+        'target_duration': args.target_duration,
+        'timeout': args.timeout,
+        'n_procs': args.num_procs,
+        'max_tries': args.max_tries,
+        'persistent': args.persistent,
+        'batch_size': args.batch_size,
+        'profile': args.profile,
+    }
+    run_local(exp, tag, **kwargs)
+
+
+def create_local_parser(parser):
+    parser.add_argument(
+        "-e", "--exp",
+        required=True,
+        help="Experiment version.")
+    parser.add_argument(
+        "-t", "--tag",
+        required=True,
+        help="Simulation tag. A short label for this simulation config.")
+    parser.add_argument(
+        "-f", "--force",
+        action="store_true",
+        help="Force all tasks to be run.")
+    parser.add_argument(
+        "-d", "--target-duration",
+        default=None,
+        dest="target_duration",
+        type=float,
+        help=("Size new tasks to take about this many seconds, based on "
+              "the measured costs of earlier runs."))
+    parser.add_argument(
+        "-T", "--timeout",
+        default=310,
+        type=int,
+        help="Timeout (in seconds) before process restarts.")
+    parser.add_argument(
+        "-n", "--num-processes",
+        default=mp.cpu_count(),
+        dest="num_procs",
+        type=int,
+        help="Number of simulation processes.")
+    parser.add_argument(
+        "-m", "--max-tries",
+        default=3,
+        dest="max_tries",
+        type=int,
+        help="Number of times to try running a task.")
+    parser.add_argument(
+        "-p", "--persistent",
+        action="store_true",
+        help=("Keep one long-lived simulation process per worker, instead "
+              "of starting a new process for every task."))
+    parser.add_argument(
+        "-b", "--batch-size",
+        default=1,
+        dest="batch_size",
+        type=int,
+        help=("Maximum number of conditions (differing only in kappa) to "
+              "simulate together in one physics world, up to %d." %
+              MAX_BATCH_SIZE))
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=("Time each phase of the simulations, and save the timings "
+              "next to the data."))
+    parser.set_defaults(func=parse_and_run_local)
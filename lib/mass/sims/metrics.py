@@ -0,0 +1,177 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import defaultdict, deque
+from datetime import datetime
+from threading import Lock, Thread
+import json
+import logging
+import time
+
+logger = logging.getLogger("mass.sims.metrics")
+
+
+class Metrics(object):
+    """Throughput, failure and queue statistics for a running server,
+    as they stand now (`snapshot`). Rates are given both over the
+    whole run and over the last `window` seconds. If the clients are
+    profiling their simulations, the time spent in each phase of the
+    simulations is added up, too."""
+
+    def __init__(self, window=60):
+        self.window = window
+        self.lock = Lock()
+        self.start_time = time.time()
+
+        # (time, conditions, simulated seconds) of each finished task
+        # within the window
+        self.recent = deque()
+        self.n_conditions = 0
+        self.sim_time = 0.
+        self.counts = defaultdict(int)
+        self.queue_depth = 0
+
+        self.clients = defaultdict(lambda: {
+            'first_seen': time.time(),
+            'tasks': 0,
+            'conditions': 0,
+            'busy_seconds': 0.,
+            'timeouts': 0,
+            'errors': 0,
+            'failed': 0,
+        })
+        self.stimuli = defaultdict(lambda: {
+            'tasks': 0,
+            'conditions': 0,
+            'seconds': 0.,
+        })
+        self.experiments = {}
+        self.phases = defaultdict(lambda: {'seconds': 0., 'calls': 0})
+        self.n_timed = 0
+
+    def task_done(self, client, stim, n_conditions, elapsed, sim_time=None,
+                  timing=None):
+        with self.lock:
+            now = time.time()
+            self.recent.append((now, n_conditions, sim_time or 0.))
+            self.n_conditions += n_conditions
+            self.sim_time += sim_time or 0.
+            self.counts['done'] += 1
+
+            stats = self.clients[client]
+            stats['tasks'] += 1
+            stats['conditions'] += n_conditions
+            stats['busy_seconds'] += elapsed
+
+            stats = self.stimuli[stim]
+            stats['tasks'] += 1
+            stats['conditions'] += n_conditions
+            stats['seconds'] += elapsed
+
+            if timing:
+                self.n_timed += n_conditions
+                for phase, stats in timing.iteritems():
+                    self.phases[phase]['seconds'] += stats['seconds']
+                    self.phases[phase]['calls'] += stats['calls']
+
+    def task_retried(self, client, reason):
+        """Count a failed attempt at a task (`reason` is either
+        'timeout' or 'error')."""
+        with self.lock:
+            key = 'timeouts' if reason == 'timeout' else 'errors'
+            self.counts[key] += 1
+            self.clients[client][key] += 1
+
+    def task_failed(self, client):
+        with self.lock:
+            self.counts['failed'] += 1
+            self.clients[client]['failed'] += 1
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def set_queue_depth(self, depth):
+        with self.lock:
+            self.queue_depth = depth
+
+    def set_progress(self, name, num_finished, num_tasks):
+        with self.lock:
+            self.experiments[name] = {
+                'finished': num_finished,
+                'total': num_tasks,
+            }
+
+    def snapshot(self):
+        with self.lock:
+            now = time.time()
+            while self.recent and self.recent[0][0] < now - self.window:
+                self.recent.popleft()
+
+            elapsed = max(now - self.start_time, 1e-9)
+            window = min(self.window, elapsed)
+            recent_conditions = sum(x[1] for x in self.recent)
+            recent_sim_time = sum(x[2] for x in self.recent)
+
+            clients = {}
+            for client, stats in self.clients.iteritems():
+                stats = dict(stats)
+                age = max(now - stats.pop('first_seen'), 1e-9)
+                stats['conditions_per_second'] = stats['conditions'] / age
+                clients[client] = stats
+
+            stimuli = {}
+            for stim, stats in self.stimuli.iteritems():
+                stats = dict(stats)
+                stats['seconds_per_condition'] = (
+                    stats['seconds'] / max(stats['conditions'], 1))
+                stimuli[stim] = stats
+
+            phases = {}
+            for phase, stats in self.phases.iteritems():
+                stats = dict(stats)
+                stats['per_condition'] = stats['seconds'] / self.n_timed
+                phases[phase] = stats
+
+            return {
+                'time': datetime.now().isoformat(),
+                'elapsed': elapsed,
+                'conditions': self.n_conditions,
+                'conditions_per_second': self.n_conditions / elapsed,
+                'recent_conditions_per_second': recent_conditions / window,
+                'sim_seconds_per_second': self.sim_time / elapsed,
+                'recent_sim_seconds_per_second': recent_sim_time / window,
+                'queue_depth': self.queue_depth,
+                'counts': dict(self.counts),
+                'clients': clients,
+                'stimuli': stimuli,
+                'experiments': dict(self.experiments),
+                'phases': phases,
+            }
+
+    def write(self, filename):
+        """Append a snapshot to a JSON lines file."""
+        with open(filename, "a") as fh:
+            fh.write(json.dumps(self.snapshot()) + "\n")
+
+
+def serve_metrics(metrics, address):
+    """Serve snapshots of `metrics` as JSON over HTTP at `address`
+    (a (host, port) tuple), from a background thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(metrics.snapshot(), indent=2)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    httpd = HTTPServer(address, Handler)
+    thread = Thread(name="Metrics", target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving metrics at http://%s:%d/", *httpd.server_address)
+    return httpd
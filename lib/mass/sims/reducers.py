@@ -0,0 +1,126 @@
+"""Reductions of the simulated trajectories to a few statistics per
+condition, computed by the simulations themselves as soon as each
+condition has been simulated, so that the trajectories don't need to be
+stored."""
+
+from path import path
+import numpy as np
+import os
+
+
+def reduced_path(data_path, name):
+    """Path of the table of the reducer `name`, next to the data of a
+    task."""
+    data_path = path(data_path)
+    return data_path.dirname().joinpath(
+        "%s.%s.npy" % (data_path.namebase, name))
+
+
+def save_reduced(task, reduced):
+    """Save the tables of the reducers (a dictionary from reducer name
+    to table) next to the data of a task. Like the data, they are
+    written to a temporary file first, so they never appear partially
+    written."""
+    for name, table in reduced.iteritems():
+        table_path = reduced_path(task['data_path'], name)
+        tmp_path = "%s.%d.tmp" % (table_path, os.getpid())
+        with open(tmp_path, "wb") as fh:
+            np.save(fh, np.asarray(table))
+        os.rename(tmp_path, table_path)
+
+
+class Reducer(object):
+    """Base class for reducers. A reducer is created for each task, and
+    `reduce` is called with the data of each of the task's conditions,
+    which is an array of shape (timestep, object, posquat) holding the
+    timesteps that the script keeps. It returns one value for each of
+    the reducer's `columns`.
+
+    """
+
+    name = None
+    columns = ()
+
+    def __init__(self, task, params):
+        self.task = task
+        self.params = params
+
+    def reduce(self, data):
+        raise NotImplementedError
+
+
+class FallReducer(Reducer):
+    """Which blocks fell, how far, and in which direction -- the same
+    statistics that `query_model.process_model_nmoved` computes from
+    the stored trajectories.
+
+    The movement of a block is its squared displacement between the
+    post-repel and the final state, and a block fell if it moved more
+    than the script's `fall_threshold`. Like pandas, blocks whose
+    movement is NaN are left out of the statistics.
+
+    """
+
+    name = 'fall'
+    columns = (
+        'nfell',
+        'total movement',
+        'median movement',
+        'block0',
+        'block1',
+        'direction'
+    )
+
+    def __init__(self, task, params):
+        super(FallReducer, self).__init__(task, params)
+        self.mthresh = params['simulation'].get('fall_threshold', 0.0025)
+
+        # The stimulus name gives the type of each block, in the order
+        # of the sorted object names. Stimuli that don't have block
+        # types get NaN block movements.
+        stim = path(task['cpo_path']).namebase
+        try:
+            types = np.array([int(b) for b in stim.split("_")[2]])
+        except (IndexError, ValueError):
+            types = None
+        order = np.argsort(task['bodies'])
+        if types is None or len(types) != len(order):
+            self.blocktype = None
+        else:
+            self.blocktype = np.empty(len(order), dtype=int)
+            self.blocktype[order] = types
+
+    def reduce(self, data):
+        pos0 = data[1, :, :3]
+        posT = data[-1, :, :3]
+        movement = ((posT - pos0) ** 2).sum(axis=1)
+
+        moved = (movement > self.mthresh).astype(float)
+        moved[np.isnan(movement)] = np.nan
+        fell = moved == 1
+
+        if self.blocktype is None:
+            block0 = block1 = np.nan
+        else:
+            block0 = np.nansum(movement[self.blocktype == 0])
+            block1 = np.nansum(movement[self.blocktype == 1])
+
+        if fell.any():
+            diff = posT[fell].mean(axis=0) - pos0[fell].mean(axis=0)
+            direction = np.arctan2(diff[1], diff[0])
+        else:
+            direction = np.nan
+
+        return [
+            np.nansum(moved),
+            np.nansum(movement),
+            np.nanmedian(movement),
+            block0,
+            block1,
+            direction
+        ]
+
+
+REDUCERS = {
+    FallReducer.name: FallReducer,
+}
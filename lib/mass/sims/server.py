@@ -1,106 +1,537 @@
 import sys
+import Queue
 import multiprocessing as mp
 import logging
 from multiprocessing.managers import BaseManager
 from datetime import datetime, timedelta
 from path import path
-from utils import parse_address, get_params
-from tasks import Tasks
+from utils import parse_address, parse_script, get_params
+from tasks import Tasks, TaskCosts, CompletionLog, with_slices
+from reducers import save_reduced
+from storage import ResultStore, unpack
+from metrics import Metrics, serve_metrics
 
 logger = logging.getLogger("mass.sims.server")
 
 
-class ServerManager(BaseManager):
-
-    def add_tasks(self, force):
-        params = self.get_params()
+class Leases(object):
+    """Time-bounded claims that clients hold on the tasks they are
+    running. A client takes a lease when it starts a task, and has to
+    keep renewing it with heartbeats; a task whose leases have all
+    expired was probably lost along with its client."""
+
+    def __init__(self, duration):
+        self.duration = timedelta(seconds=duration)
+        self.expiry = {}
+
+    def renew(self, task_name, client):
+        expiry = datetime.now() + self.duration
+        self.expiry.setdefault(task_name, {})[client] = expiry
+
+    def release(self, task_name, client=None):
+        if client is None:
+            self.expiry.pop(task_name, None)
+        elif task_name in self.expiry:
+            self.expiry[task_name].pop(client, None)
+            if not self.expiry[task_name]:
+                del self.expiry[task_name]
+
+    def pop_expired(self):
+        """Remove and return the names of the tasks whose leases have
+        all expired."""
+        now = datetime.now()
+        expired = [
+            task_name for task_name, clients in self.expiry.iteritems()
+            if max(clients.values()) < now]
+        for task_name in expired:
+            del self.expiry[task_name]
+        return expired
+
+
+class Experiment(object):
+    """Everything the server keeps track of for one simulation script:
+    its parameters, its tasks, and the logs of which tasks have been
+    completed and how long they took.
+
+    Experiments with a higher `priority` get all of their tasks handed
+    out before those with a lower priority; experiments with the same
+    priority share the clients in proportion to their `weight`.
+
+    """
+
+    def __init__(self, exp, tag, weight=1, priority=0):
+        self.name = "%s/%s" % (exp, tag)
+        self.weight = float(weight)
+        self.priority = priority
+        if self.weight <= 0:
+            raise ValueError("weight of %s must be positive" % self.name)
+
+        self.params = get_params(exp, tag)
+        self.completed_log = CompletionLog(self.params["completed_path"])
+        self.costs_file = self.params["costs_path"]
+        self.costs = TaskCosts.load(self.costs_file)
+        self.store = ResultStore(self.params["store_path"], self.params)
+
+        # all the tasks to run, and the names of those that haven't
+        # been handed out yet, in the order in which to hand them out
+        self.tasks = Tasks()
+        # the tasks to run along with those completed in earlier runs
+        self.all_tasks = Tasks()
+        self.pending = []
+        # the tasks that have been handed out, with their noises and
+        # forces, by task id
+        self.queued = {}
+        # estimated seconds of simulation handed out so far
+        self.dispatched = 0.
+
+        self.finished = set()
+        self.failed = set()
+        self.num_processed = 0
+        self.start_time = None
+
+    def task_id(self, task_name):
+        """The name under which a task of this experiment is known to
+        the clients, which is unique across experiments."""
+        return "%s/%s" % (self.name, task_name)
+
+    def expected_cost(self, task_name):
+        """Estimated time (in seconds) to run a task. Stimuli we have
+        not measured yet are assumed to have the average cost."""
+        task = self.tasks[task_name]
+        estimate = self.costs.estimate(task)
+        if estimate is None:
+            mean_cost = self.costs.mean_per_condition() or 1.
+            estimate = mean_cost * len(task['conditions'])
+        return estimate
+
+    def load_tasks(self, force, target_duration=None, timeout=None):
+        """Load the tasks that have not been completed yet.
+
+        Tasks are sized using the per-condition costs measured in
+        earlier runs: new tasks are created to take about
+        `target_duration` seconds each, and pending tasks that are
+        expected to take longer than `timeout` seconds are split.
 
+        """
+        params = self.params
         tasks_file = path(params["tasks_path"])
-        completed_file = tasks_file.dirname().joinpath("completed.json")
+        completed_log = self.completed_log
+        costs = self.costs
         if tasks_file.exists() and not force:
             tasks = Tasks.load(tasks_file)
-            completed = Tasks.load(completed_file)
-        else:
-            tasks, completed = Tasks.create(params)
-            tasks.save(tasks_file)
-            completed.save(completed_file)
-
-        task_queue = self.get_task_queue()
-        added_tasks = Tasks()
-        for task_name in sorted(tasks.keys()):
-            task = tasks[task_name]
-            complete = completed[task_name]
-            if force or not complete:
-                task_queue.put(task)
-                added_tasks[task_name] = task
 
-        logger.info("%d tasks queued", len(added_tasks))
-        return added_tasks
+            # older runs kept track of completed tasks in a JSON file
+            completed_file = tasks_file.dirname().joinpath("completed.json")
+            if completed_file.exists() and not completed_log.filename.exists():
+                completed = Tasks.load(completed_file)
+                completed_log.save(
+                    [name for name in completed if completed[name]])
 
-    def manage_tasks(self, tasks):
-        """Receives completed tasks from the clients and updates the tasks
-        file.
+            completed = completed_log.compact()
+        else:
+            tasks = Tasks.create(
+                params, costs=costs, target_duration=target_duration)
+            tasks.save(tasks_file)
+            completed = set()
+            completed_log.save(completed)
+            # nothing that was streamed for the old tasks counts anymore
+            self.store.remove()
+
+        # split up pending tasks that probably won't finish in time
+        if timeout:
+            num_split = 0
+            for task_name in sorted(tasks.keys()):
+                if task_name in completed and not force:
+                    continue
+                task = tasks[task_name]
+                estimate = costs.estimate(task)
+                if estimate is None or estimate <= timeout:
+                    continue
+                chunk_size = max(1, int(
+                    len(task['conditions']) * timeout / estimate))
+                if len(tasks.split(task_name, chunk_size)) > 1:
+                    num_split += 1
+            if num_split > 0:
+                logger.info("Split %d tasks of %s that would exceed the "
+                            "timeout", num_split, self.name)
+                tasks.save(tasks_file)
+
+        self.all_tasks = tasks
+        self.tasks = Tasks()
+        for task_name in tasks:
+            if force or task_name not in completed:
+                self.tasks[task_name] = tasks[task_name]
+
+        # hand out the tasks that we expect to take longest first, so
+        # that they don't hold up the end of the run
+        self.pending = sorted(
+            self.tasks.keys(),
+            key=lambda x: (-self.expected_cost(x), x))
+
+        # an earlier run may have stopped in between two rounds of
+        # kappa refinement or sequential sampling
+        if not self.tasks:
+            self.refine()
+
+        logger.info("%d tasks of %s to run", len(self.tasks), self.name)
+        return self.tasks
+
+    def refine(self):
+        """If the script refines its kappa grid adaptively (see
+        `Tasks.refine`) or samples sequentially (see
+        `Tasks.next_wave`), add the tasks of the next round, once all
+        the tasks so far are done. Returns the names of the new
+        tasks."""
+        names = []
+        if 'kappa_refinement' in self.params:
+            names.extend(self.all_tasks.refine(self.params, self.failed))
+        if 'sequential_sampling' in self.params:
+            names.extend(
+                self.all_tasks.next_wave(self.params, self.failed))
+        if not names:
+            return []
+
+        self.all_tasks.save(self.params["tasks_path"])
+        for task_name in names:
+            self.tasks[task_name] = self.all_tasks[task_name]
+        self.pending.extend(sorted(
+            names, key=lambda x: (-self.expected_cost(x), x)))
+
+        n_conditions = sum(
+            len(self.tasks[x]['conditions']) for x in names)
+        logger.info("Next round of %s: %d more conditions in %d tasks",
+                    self.name, n_conditions, len(names))
+        return names
+
+    def next_task(self):
+        """Take the next pending task, along with its noises, forces,
+        and physics parameters."""
+        task_name = self.pending.pop(0)
+        self.dispatched += self.expected_cost(task_name)
+
+        task = with_slices(
+            self.tasks[task_name],
+            self.params['noises'], self.params['forces'])
+        task['task_name'] = self.task_id(task_name)
+        task['physics'] = self.params['physics']
+        task['simulation'] = self.params['simulation']
+        self.queued[task['task_name']] = task
+        return task
+
+    def share(self):
+        """How much of its fair share of the clients this experiment has
+        used so far; the experiment with the lowest share goes next."""
+        return (-self.priority, self.dispatched / self.weight)
+
+    def complete(self):
+        return len(self.finished) == len(self.tasks)
+
+
+class TaskManager(object):
+    """Hands out the tasks of one or more simulation scripts, and keeps
+    track of them as they are run. Subclasses provide the shared
+    resources, through `get_task_queue` and `get_done_queue`."""
+
+    def manage_tasks(self, experiments, speculate=True, poll_interval=5,
+                     lease_duration=60, queue_depth=16, max_speculative=4,
+                     metrics=None, metrics_file=None, metrics_interval=10):
+        """Hands out the tasks of all the `experiments`, receives
+        reports from the clients about the tasks they are running (one
+        at a time, or in batches), and updates the completion logs as
+        completed tasks arrive.
+
+        Rather than putting all the tasks on the queue at once, the
+        queue is kept topped up with about `queue_depth` tasks, taken
+        from the experiment that is furthest below its share (see
+        `Experiment.share`). That way, all the experiments make
+        progress at once, and the whole cluster keeps working until the
+        last one is done.
+
+        Clients hold leases on the tasks they have fetched (whether
+        they are running them or have them waiting in their prefetch
+        buffer), which they renew with heartbeats. If a task's leases
+        expire before it is finished (e.g. because its client died), it
+        is put back on the queue.
+
+        Clients that stream their results send the data of each task
+        along with its 'done' report, and it is written into the
+        experiment's `ResultStore` before the task is marked as
+        complete.
+
+        Once the queue runs dry, idle clients would otherwise have to
+        wait for the stragglers. So if `speculate` is True, whenever
+        the queue is empty and the clients' heartbeats report idle
+        workers, we put a duplicate of the longest-running outstanding
+        task on it (each task is only duplicated once, and at most
+        `max_speculative` duplicates are outstanding at a time), and
+        keep whichever attempt finishes first.
+
+        Throughput, failures and queue depth are recorded in `metrics`
+        (a `Metrics` object), and a snapshot of them is appended to
+        `metrics_file` every `metrics_interval` seconds.
+
+        Returns the ids of the tasks that failed.
 
         """
 
-        start_time = datetime.now()
-        params = self.get_params()
-
-        tasks_file = path(params["tasks_path"])
-        completed_file = tasks_file.dirname().joinpath("completed.json")
-        num_tasks = len(tasks)
-
         task_queue = self.get_task_queue()
         done_queue = self.get_done_queue()
-
-        try:
-            num_remaining = task_queue.qsize()
-        except NotImplementedError:
-            num_remaining = num_tasks
-        num_processed = 0
-
-        def running():
-            return (not task_queue.empty() or
-                    task_queue.join() or
-                    not done_queue.empty())
-
-        # Main task loop. Stopping criteria: no more tasks and all
-        # clients have signaled task done.
-        while running():
-            # Wait for a done task to arrive.
-            task_name = done_queue.get()
-            completed = Tasks.load(completed_file)
-            completed[task_name] = True
-
-            # Save task to disk.
-            completed.save(completed_file)
-
-            # Report progress.
-            num_processed += 1
+        if metrics is None:
+            metrics = Metrics()
+        last_write = datetime.now()
+
+        # which experiment each task id belongs to, and the task's name
+        # within that experiment
+        owners = {}
+        for experiment in experiments:
+            experiment.start_time = datetime.now()
+            for task_name in experiment.tasks:
+                owners[experiment.task_id(task_name)] = (
+                    experiment, task_name)
+
+        # when each task was first started
+        started = {}
+        speculated = set()
+        leases = Leases(lease_duration)
+        # how many idle workers each client reported in its last
+        # heartbeat, and when
+        idle = {}
+
+        # how many tasks have been put on the queue and taken off it by
+        # the clients, to tell how full the queue is where it can't tell
+        # its own size (e.g. on OS X)
+        queue_counts = {'put': 0, 'taken': 0}
+
+        def put(task):
+            task_queue.put(task)
+            queue_counts['put'] += 1
+
+        def queue_size():
             try:
-                num_remaining = task_queue.qsize()
+                return task_queue.qsize()
             except NotImplementedError:
-                num_remaining -= 1
-            num_finished = num_tasks - num_remaining
+                return max(0, queue_counts['put'] - queue_counts['taken'])
+
+        def outstanding(task_id):
+            experiment, task_name = owners[task_id]
+            return task_name not in experiment.finished
+
+        def dispatch():
+            waiting = [x for x in experiments if x.pending]
+            depth = queue_size()
+            while waiting and depth < queue_depth:
+                experiment = min(waiting, key=lambda x: x.share())
+                put(experiment.next_task())
+                depth += 1
+                waiting = [x for x in experiments if x.pending]
+            metrics.set_queue_depth(depth)
+
+        def idle_workers():
+            now = datetime.now()
+            return sum(
+                n for n, when in idle.itervalues()
+                if (now - when).total_seconds() <= lease_duration)
+
+        def speculate_task():
+            running = sum(1 for x in speculated if outstanding(x))
+            if running >= min(idle_workers(), max_speculative):
+                return
+            candidates = [
+                task_id for task_id in started
+                if outstanding(task_id) and task_id not in speculated]
+            if not candidates:
+                return
+            task_id = min(candidates, key=lambda x: started[x])
+            logger.info("Queueing duplicate of task `%s` (running for %s)",
+                        task_id, str(datetime.now() - started[task_id]))
+            speculated.add(task_id)
+            # the duplicate may run at the same time as the original, so
+            # it must not share the original's checkpoint
+            put(dict(owners[task_id][0].queued[task_id], speculative=True))
+            metrics.count('speculated')
+
+        def finish(experiment, task_name, report):
+            experiment.finished.add(task_name)
+            experiment.failed.discard(task_name)
+
+            # Record the completion on disk.
+            experiment.completed_log.append(task_name)
+
+            # Record how long the task took, for sizing later tasks.
+            stim = path(experiment.tasks[task_name]['cpo_path']).namebase
+            experiment.costs.add(
+                stim, report['elapsed'], report['n_conditions'])
+            experiment.costs.save(experiment.costs_file)
+
+            metrics.task_done(
+                report['client'], stim, report['n_conditions'],
+                report['elapsed'], sim_time=report.get('sim_time'),
+                timing=report.get('timing'))
+
+            # Report progress.
+            experiment.num_processed += 1
+            num_tasks = len(experiment.tasks)
+            num_finished = len(experiment.finished)
+            num_remaining = num_tasks - num_finished
             progress = 100 * float(num_finished) / num_tasks
-            dt = datetime.now() - start_time
-            avg_dt = timedelta(
-                seconds=(dt.total_seconds() / float(num_processed + 1e-5)))
+            metrics.set_progress(experiment.name, num_finished, num_tasks)
+            dt = datetime.now() - experiment.start_time
+            avg_dt = timedelta(seconds=(
+                dt.total_seconds() / float(experiment.num_processed)))
             time_left = timedelta(
                 seconds=(avg_dt.total_seconds() * num_remaining))
 
             logger.info("-" * 60)
             logger.info("Task `%s` complete", task_name)
-            logger.info("Progress: %d/%d (%.2f%%)",
-                        num_finished, num_tasks, progress)
+            logger.info("Progress of %s: %d/%d (%.2f%%)",
+                        experiment.name, num_finished, num_tasks, progress)
             logger.info("Time elapsed  : %s", str(dt))
             logger.info("Time per task : %s", str(avg_dt))
             logger.info("Time remaining: %s", str(time_left))
 
+            # Once a round of kappa refinement or sequential sampling is
+            # done, start the next.
+            if experiment.complete():
+                for task_name in experiment.refine():
+                    owners[experiment.task_id(task_name)] = (
+                        experiment, task_name)
+
+            if experiment.complete():
+                logger.info("All tasks of %s are done", experiment.name)
+                experiment.completed_log.compact()
+
+        # Main task loop. Stopping criteria: every task of every
+        # experiment has either been completed or failed.
+        while not all(x.complete() for x in experiments):
+            dispatch()
+
+            # Wait for a report to arrive.
+            try:
+                report = done_queue.get(timeout=poll_interval)
+            except Queue.Empty:
+                report = None
+
+            # Clients send their reports in batches.
+            if report is None:
+                reports = []
+            elif report['status'] == 'batch':
+                reports = report['reports']
+            else:
+                reports = [report]
+
+            for report in reports:
+                if report['status'] == 'heartbeat':
+                    idle[report['client']] = (
+                        report.get('idle', 0), datetime.now())
+                    for task_id in report['task_names']:
+                        if task_id in owners and outstanding(task_id):
+                            leases.renew(task_id, report['client'])
+                    continue
+
+                task_id = report['task_name']
+                if task_id not in owners:
+                    logger.warning("Report on unknown task `%s`", task_id)
+                    continue
+                experiment, task_name = owners[task_id]
+
+                if report['status'] == 'fetched':
+                    queue_counts['taken'] += 1
+                    if outstanding(task_id):
+                        leases.renew(task_id, report['client'])
+
+                elif report['status'] == 'started':
+                    started.setdefault(task_id, datetime.now())
+                    if outstanding(task_id):
+                        leases.renew(task_id, report['client'])
+
+                elif report['status'] == 'released':
+                    # the client put the task back on the queue
+                    queue_counts['put'] += 1
+                    leases.release(task_id, report['client'])
+                    if report.get('reason') in ('timeout', 'error'):
+                        metrics.task_retried(
+                            report['client'], report['reason'])
+
+                elif report['status'] == 'failed':
+                    leases.release(task_id)
+                    if report.get('reason') in ('timeout', 'error'):
+                        metrics.task_retried(
+                            report['client'], report['reason'])
+                    metrics.task_failed(report['client'])
+                    if outstanding(task_id):
+                        logger.error("Task `%s` failed", task_id)
+                        experiment.finished.add(task_name)
+                        experiment.failed.add(task_name)
+
+                elif report['status'] == 'done':
+                    leases.release(task_id)
+
+                    # A duplicate attempt already finished first.
+                    if (task_name in experiment.finished and
+                            task_name not in experiment.failed):
+                        logger.info("Ignoring duplicate of task `%s`",
+                                    task_id)
+                        metrics.count('duplicates')
+                        continue
+
+                    # Store the data, if it was sent along.
+                    if report.get('data') is not None:
+                        if experiment.store.data is None:
+                            experiment.store.open(create=True)
+                        experiment.store.write(
+                            experiment.tasks[task_name],
+                            unpack(report['data']))
+                    if report.get('reduced'):
+                        save_reduced(
+                            experiment.tasks[task_name], report['reduced'])
+
+                    finish(experiment, task_name, report)
+
+            # Put tasks that have been lost back on the queue.
+            for task_id in leases.pop_expired():
+                if not outstanding(task_id):
+                    continue
+                logger.warning("Lease on task `%s` expired, requeueing",
+                               task_id)
+                put(owners[task_id][0].queued[task_id])
+                metrics.count('expired')
+
+            pending = any(x.pending for x in experiments)
+            if speculate and not pending and task_queue.empty():
+                speculate_task()
+
+            # Save a snapshot of the metrics now and then.
+            now = datetime.now()
+            since_write = (now - last_write).total_seconds()
+            if metrics_file and since_write >= metrics_interval:
+                metrics.write(metrics_file)
+                last_write = now
+
+        if metrics_file:
+            metrics.write(metrics_file)
+
+        failed = []
+        for experiment in experiments:
+            failed.extend(
+                experiment.task_id(x) for x in sorted(experiment.failed))
+            experiment.completed_log.compact()
+        if failed:
+            logger.error("%d tasks failed: %s", len(failed), ", ".join(failed))
+
+        return failed
+
+
+class ServerManager(TaskManager, BaseManager):
+    """Serves the tasks of simulation scripts to clients over the
+    network."""
+
     @classmethod
     def register_shared(cls, with_callable, params=None):
         if with_callable:
-            task_queue = mp.JoinableQueue()
+            # the server keeps track of the tasks through the clients'
+            # reports, so the queue doesn't need to (and the clients
+            # don't make a round trip to acknowledge each task)
+            task_queue = mp.Queue()
             done_queue = mp.Queue()
 
             cls.register(
@@ -119,26 +550,54 @@ class ServerManager(BaseManager):
             cls.register("get_done_queue")
 
 
-def run_server(exp, tag, **kwargs):
-    """Run the simulation server manager."""
+def run_server(scripts, **kwargs):
+    """Run the simulation server manager for the given simulation
+    scripts, a list of (exp, tag, weight, priority) tuples."""
 
     address = kwargs.get("address", ("127.0.0.1", 50000))
     authkey = kwargs.get("authkey", None)
     force = kwargs.get("force", False)
+    target_duration = kwargs.get("target_duration", None)
+    timeout = kwargs.get("timeout", None)
+    speculate = kwargs.get("speculate", True)
+    lease = kwargs.get("lease", 60)
+    queue_depth = kwargs.get("queue_depth", 16)
+    max_speculative = kwargs.get("max_speculative", 4)
+    metrics_file = kwargs.get("metrics_file", None)
+    metrics_address = kwargs.get("metrics_address", None)
 
     # Set up parameters and task data.
-    params = get_params(exp, tag)
+    experiments = []
+    for exp, tag, weight, priority in scripts:
+        experiment = Experiment(exp, tag, weight=weight, priority=priority)
+        experiment.load_tasks(
+            force, target_duration=target_duration, timeout=timeout)
+        experiments.append(experiment)
+
+    params = dict((x.name, x.params) for x in experiments)
     ServerManager.register_shared(with_callable=True, params=params)
-    logger.info("Registered shared resources")
 
-    # Start the server and set the shared data.
+    # Start the server.
     mgr = ServerManager(address=address, authkey=authkey)
     mgr.start()
-    tasks = mgr.add_tasks(force)
 
-    # Monitor the tasks and update the tasks file as completed tasks
-    # arrive from the clients.
-    mgr.manage_tasks(tasks)
+    # Keep track of how the simulations are going. By default, the
+    # metrics go next to the (first) simulation script's tasks.
+    metrics = Metrics()
+    if metrics_file is None:
+        metrics_file = experiments[0].params["metrics_path"]
+    if metrics_address is not None:
+        httpd = serve_metrics(metrics, metrics_address)
+
+    # Hand out the tasks and update the completion logs as completed
+    # tasks arrive from the clients.
+    mgr.manage_tasks(
+        experiments, speculate=speculate, lease_duration=lease,
+        queue_depth=queue_depth, max_speculative=max_speculative,
+        metrics=metrics, metrics_file=metrics_file)
+
+    if metrics_address is not None:
+        httpd.shutdown()
 
     logger.info("Jobs complete. Shutting down.")
     mgr.shutdown()
@@ -146,25 +605,46 @@ def run_server(exp, tag, **kwargs):
 
 
 def parse_and_run_server(args):
-    exp = args.exp
-    tag = args.tag
+    scripts = list(args.scripts or [])
+    if args.exp and args.tag:
+        scripts.insert(0, (args.exp, args.tag, 1, 0))
+    elif args.exp or args.tag:
+        raise ValueError("--exp and --tag must be given together")
+    if not scripts:
+        raise ValueError("no simulation scripts given")
+
     kwargs = {
         'address': args.address,
         'authkey': args.authkey,
         'force': args.force,
+        'target_duration': args.target_duration,
+        'timeout': args.timeout,
+        'speculate': args.speculate,
+        'lease': args.lease,
+        'queue_depth': args.queue_depth,
+        'max_speculative': args.max_speculative,
+        'metrics_file': args.metrics_file,
+        'metrics_address': args.metrics_address,
     }
-    run_server(exp, tag, **kwargs)
+    run_server(scripts, **kwargs)
 
 
 def create_server_parser(parser):
     parser.add_argument(
         "-e", "--exp",
-        required=True,
+        default=None,
         help="Experiment version.")
     parser.add_argument(
         "-t", "--tag",
-        required=True,
+        default=None,
         help="Simulation tag. A short label for this simulation config.")
+    parser.add_argument(
+        "-x", "--script",
+        action="append",
+        dest="scripts",
+        type=parse_script,
+        help=("Another simulation script to serve, as exp:tag[:weight"
+              "[:priority]]. Can be given several times."))
     parser.add_argument(
         "-a", "--address",
         default=("127.0.0.1", 50000),
@@ -178,4 +658,55 @@ def create_server_parser(parser):
         "-f", "--force",
         action="store_true",
         help="Force all tasks to be put on the queue.")
+    parser.add_argument(
+        "-d", "--target-duration",
+        default=None,
+        dest="target_duration",
+        type=float,
+        help=("Size new tasks to take about this many seconds, based on "
+              "the measured costs of earlier runs."))
+    parser.add_argument(
+        "-T", "--timeout",
+        default=310,
+        type=float,
+        help=("Split pending tasks that are expected to take longer than "
+              "this many seconds (should match the clients' timeout)."))
+    parser.add_argument(
+        "--no-speculation",
+        action="store_false",
+        dest="speculate",
+        help=("Don't queue duplicates of the longest-running tasks when "
+              "the queue is empty."))
+    parser.add_argument(
+        "--max-speculative",
+        default=4,
+        dest="max_speculative",
+        type=int,
+        help=("Maximum number of duplicates of slow tasks to have "
+              "outstanding at once."))
+    parser.add_argument(
+        "-l", "--lease",
+        default=60,
+        type=float,
+        help=("Time (in seconds) after a client's last heartbeat before "
+              "its tasks are put back on the queue."))
+    parser.add_argument(
+        "-q", "--queue-depth",
+        default=16,
+        dest="queue_depth",
+        type=int,
+        help=("Number of tasks to keep on the queue at once. Shallower "
+              "queues follow the experiments' shares more closely."))
+    parser.add_argument(
+        "--metrics-file",
+        default=None,
+        dest="metrics_file",
+        help=("JSON lines file to append snapshots of the throughput "
+              "metrics to (default: metrics.jsonl next to the tasks)."))
+    parser.add_argument(
+        "--metrics-address",
+        default=None,
+        dest="metrics_address",
+        type=parse_address,
+        help="Address (host:port) at which to serve the metrics over HTTP.")
     parser.set_defaults(func=parse_and_run_server)
@@ -1,17 +1,27 @@
+from collections import defaultdict
 from contextlib import contextmanager
+from datapackage import save_posquat
 from datetime import datetime, timedelta
-from libpanda import Point3, BitMask32
+from itertools import izip
+from libpanda import Point3, Quat, Vec3, BitMask32
 from mass.stimuli import PSOStyler, get_blocktypes, get_style
 from multiprocessing import Process
-from pandac.PandaModules import NodePathCollection
+from pandac.PandaModules import NodePathCollection, ConfigVariableInt
 from path import path
+from reducers import REDUCERS, save_reduced
 from scenesim.objects.pso import PSO
 from scenesim.objects.sso import SSO
 from scenesim.physics.bulletbase import BulletBase
+from storage import pack
 from utils import load_cpo
+import hashlib
+import json
 import multiprocessing as mp
 import numpy as np
+import os
+import socket
 import sys
+import time
 
 
 def get_force(angle, mag):
@@ -23,8 +33,95 @@ def get_force(angle, mag):
 
 
 def read(data, pcpos):
-    """Records states of all pcpos."""
-    data[:] = [np.hstack((pcpo.getPos(), pcpo.getQuat())) for pcpo in pcpos]
+    """Records states of all pcpos. The positions and quaternions are
+    written straight into the rows of `data` (an array of shape
+    (len(pcpos), 7)), reading each node's transform only once."""
+    for row, pcpo in izip(data, pcpos):
+        state = pcpo.node().getTransform()
+        row[:3] = state.getPos()
+        row[3:] = state.getQuat()
+
+
+def at_rest(pcpos, thresh):
+    """Checks whether the linear and angular speeds of all pcpos are
+    below `thresh`."""
+    for pcpo in pcpos:
+        node = pcpo.node()
+        if node.getLinearVelocity().length() > thresh:
+            return False
+        if node.getAngularVelocity().length() > thresh:
+            return False
+    return True
+
+
+def write(data, pcpos):
+    """Sets the states of all pcpos (the inverse of `read`)."""
+    for pcpo, posquat in zip(pcpos, data):
+        pcpo.setPosQuat(Point3(*posquat[:3]), Quat(*posquat[3:]))
+
+
+def read_velocities(pcpos):
+    """Returns the linear and angular velocities of all pcpos, as an
+    array of shape (len(pcpos), 6)."""
+    velocities = np.empty((len(pcpos), 6))
+    for row, pcpo in izip(velocities, pcpos):
+        node = pcpo.node()
+        row[:3] = node.getLinearVelocity()
+        row[3:] = node.getAngularVelocity()
+    return velocities
+
+
+def write_velocities(velocities, pcpos):
+    """Sets the velocities of all pcpos (the inverse of
+    `read_velocities`)."""
+    for pcpo, vel in zip(pcpos, velocities):
+        node = pcpo.node()
+        node.setLinearVelocity(Vec3(*vel[:3]))
+        node.setAngularVelocity(Vec3(*vel[3:]))
+
+
+class PhaseTimer(object):
+    """Accumulates the wall time spent in each phase of a simulation.
+    Use as `with timer("phase"): ...`. Phases can be nested, in which
+    case the time of the inner phase also counts towards the outer."""
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    @contextmanager
+    def __call__(self, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.totals[phase] += time.time() - start
+            self.counts[phase] += 1
+
+    def summary(self, n_conditions):
+        """The total time, number of calls and time per condition of
+        each phase."""
+        return dict((phase, {
+            'seconds': self.totals[phase],
+            'calls': self.counts[phase],
+            'per_condition': self.totals[phase] / n_conditions,
+        }) for phase in self.totals)
+
+
+class NullTimer(object):
+    """A `PhaseTimer` that doesn't time anything."""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+    def __call__(self, phase):
+        return self
+
+    def summary(self, n_conditions):
+        return None
 
 
 class BaseSimulationError(Exception):
@@ -39,10 +136,39 @@ class CpoMismatchError(BaseSimulationError):
     pass
 
 
+# Each copy of the tower in a batch gets its own collision bit, so
+# that copies only collide with themselves and with the floor.
+MAX_BATCH_SIZE = 32
+
+
 class Simulation(Process):
-    """Simulation job."""
+    """Simulation job.
+
+    If `stream` is True, the data of each task is packed (and, if
+    `compress` is True, compressed) so that it can be sent back to the
+    server. When `conn` is given, a message with the name of the task,
+    its packed data (or None, if not streaming), its simulated time
+    and its timing (see below) is sent over it once the task is done.
+
+    If `profile` is True, the time spent in each phase of the
+    simulation (setting up the scene, adding noise, stepping the
+    physics, reading out the states, etc.) is recorded, and sent back
+    along with the task, or saved next to its data.
+
+    The script's `reducers` (see `reducers.REDUCERS`) are run on each
+    condition as soon as it has been simulated, and their tables are
+    sent back along with the task, or saved next to its data. If the
+    script doesn't `store_trajectories`, the tables are all that is
+    kept.
+
+    """
+
+    def __init__(self, task, params, info_lock, save=False, batch_size=1,
+                 stream=False, compress=False, conn=None, profile=False):
+        if not 1 <= batch_size <= MAX_BATCH_SIZE:
+            raise ValueError(
+                "batch size must be between 1 and %d" % MAX_BATCH_SIZE)
 
-    def __init__(self, task, params, info_lock, save=False):
         self.task = task
         self.params = params
         self.info_lock = info_lock
@@ -50,16 +176,29 @@ class Simulation(Process):
         self.proclabel = None
         self.scene = None
         self.bbase = None
+        self.solver_iterations = None
         self.debug_np = None
         self.cache = None
+        self.repel_cache = {}
         self.floor = None
+        self.floor_path = None
         self.cpo = None
+        self.copies = []
         self.posquat_sz = 7
         self.save = save
+        self.batch_size = batch_size
+        self.stream = stream
+        self.compress = compress
+        self.conn = conn
+        self.result = None
+        self.reduced = None
+        self.profile = profile
+        self.timer = NullTimer()
 
         self.start_time = None
         self.end_time = None
         self.sim_time = 0
+        self.skipped_time = 0
 
         super(Simulation, self).__init__()
 
@@ -68,24 +207,26 @@ class Simulation(Process):
         """Sets up the cpo."""
         tags = ("shape",)
 
-        # Disconnect pcpos from tree.
-        parents = []
-        for pcpo in pcpos:
-            parents.append(pcpo.getParent())
-        NodePathCollection(pcpos).wrtReparentTo(self.scene)
-        self.scene.init_tree(tags=tags)
+        with self.timer("attach"):
+            # Disconnect pcpos from tree.
+            parents = []
+            for pcpo in pcpos:
+                parents.append(pcpo.getParent())
+            NodePathCollection(pcpos).wrtReparentTo(self.scene)
+            self.scene.init_tree(tags=tags)
 
-        # Add the pcpos to the Bullet world.
-        self.bbase.attach(pcpos)
+            # Add the pcpos to the Bullet world.
+            self.bbase.attach(pcpos)
         yield
 
-        # Remove the pcpos from the Bullet world.
-        self.bbase.remove(pcpos)
-        self.scene.destroy_tree(tags=tags)
+        with self.timer("detach"):
+            # Remove the pcpos from the Bullet world.
+            self.bbase.remove(pcpos)
+            self.scene.destroy_tree(tags=tags)
 
-        # Reassemble tree.
-        for pcpo, parent in zip(pcpos, parents):
-            pcpo.wrtReparentTo(parent)
+            # Reassemble tree.
+            for pcpo, parent in zip(pcpos, parents):
+                pcpo.wrtReparentTo(parent)
 
     def _add_noise(self, cpos, pcpos, noises):
         """Adds geometry noise."""
@@ -98,16 +239,37 @@ class Simulation(Process):
             cpo.setPos(self.scene, pos)
 
         # Repel.
-        with self._sim_context(pcpos):
+        with self._sim_context(pcpos), self.timer("repel"):
             self.bbase.repel(50)
 
     def _prepare_resources(self):
         """Set up all of the nodes and physics resources."""
         # Set up scene.
         self.scene = SSO("scene")
-        # Physics.
+        # Physics. Bullet only reads the number of solver iterations
+        # (None for its default) when the world is created, so we
+        # remember what this world was created with.
+        iterations = self._solver_iterations()
+        config = ConfigVariableInt("bullet-solver-iterations")
+        if iterations is None:
+            config.clearLocalValue()
+        else:
+            config.setValue(iterations)
+        self.solver_iterations = iterations
         self.bbase = BulletBase()
         self.bbase.init()
+        if self.params is not None:
+            self._configure_physics()
+
+    def _solver_iterations(self):
+        """The number of solver iterations the current parameters ask
+        for (None for Bullet's default)."""
+        if self.params is None:
+            return None
+        return self.params['simulation'].get('solver_iterations', None)
+
+    def _configure_physics(self):
+        """Apply the physics and simulation parameters to the world."""
         self.bbase.gravity = self.params["physics"]["gravity"]
         self.bbase.sim_par = {
             "size": self.params['simulation']["step_size"],
@@ -115,54 +277,90 @@ class Simulation(Process):
             "size_sub": self.params['simulation']["substep_size"],
         }
 
-    def _prepare_scene(self, cpo_path, floor_path, rec_names):
-        """Sets up the current scene."""
-        def get_name(cpo):
-            return cpo.getName()
+    def _prepare_floor(self, floor_path):
+        """Loads the floor, unless it is already in the scene."""
+        if self.floor is not None and self.floor_path == floor_path:
+            return
 
+        self._clean_floor()
         floor = load_cpo(floor_path)
         PSOStyler().apply(floor, "floor")
         floor.reparentTo(self.scene)
 
+        self.floor = floor
+        self.floor_path = floor_path
+
+    def _prepare_scene(self, cpo_path, floor_path, rec_names, n_copies=1):
+        """Sets up the current scene. If `n_copies` is greater than one,
+        extra copies of the cpo are loaded into `self.copies` (as
+        tuples of the copy, its pcpos, and its recorded cpos), so that
+        several conditions can be simulated at once.
+
+        """
+        self._prepare_floor(floor_path)
+
         cpo = load_cpo(cpo_path)
         cpo.reparentTo(self.scene)
+        pcpos = self.scene.descendants(type_=PSO)
+
+        self.copies = []
+        for icopy in xrange(1, n_copies):
+            copy = load_cpo(cpo_path)
+            copy.reparentTo(self.scene)
+            self.copies.append(copy)
 
         self.cache = self.scene.store_tree()
-        self.floor = floor
         self.cpo = cpo
 
+        # Bodies are never put to sleep, unless the script allows it
+        deactivation = self.params['simulation'].get('deactivation', False)
         self.scene.init_tree(tags=())
-        pcpos = self.scene.descendants(type_=PSO)
-        for pcpo in pcpos:
+        for pcpo in self.scene.descendants(type_=PSO):
             pcpo.setCollideMask(BitMask32.allOn())
-            pcpo.node().setDeactivationEnabled(False)
+            pcpo.node().setDeactivationEnabled(deactivation)
 
         cpos_rec = self._order_cpos(
             cpo.descendants(type_=PSO, names=rec_names))
 
+        self.copies = [
+            (copy, copy.descendants(type_=PSO), self._order_cpos(
+                copy.descendants(type_=PSO, names=rec_names)))
+            for copy in self.copies]
+
         return pcpos, cpos_rec
 
     def _clean_scene(self):
-        """Clean up the current scene."""
-        try:
-            self.scene.destroy_tree()
-        except AttributeError:
-            pass
+        """Clean up the current scene, leaving the floor and the
+        physics world in place."""
+        for cpo in [self.cpo] + [copy[0] for copy in self.copies]:
+            try:
+                cpo.destroy_tree()
+                cpo.removeNode()
+            except AttributeError:
+                pass
+        self.cache = None
+        self.cpo = None
+        self.copies = []
+
+    def _clean_floor(self):
+        """Remove the floor from the scene."""
         try:
-            self.cpo.destroy_tree()
+            self.floor.destroy_tree()
+            self.floor.removeNode()
         except AttributeError:
             pass
-        self.cache = None
-        self.scene = None
-        self.cpo = None
+        self.floor = None
+        self.floor_path = None
 
     def _clean_resources(self):
         """Clean up all resources."""
         self._clean_scene()
+        self._clean_floor()
         try:
             self.scene.destroy_tree()
         except AttributeError:
             pass
+        self.scene = None
         self.bbase.destroy()
 
     def _order_cpos(self, cpos_rec0):
@@ -189,30 +387,104 @@ class Simulation(Process):
         for cpo, blocktype in zip(cpos, blocktypes):
             styler.apply(cpo, style, blocktype=blocktype, kappa=kappa)
 
-    def _simulate(self, data, noise, force, kappa, pcpos, rec_cpos, rec_ints):
+    @contextmanager
+    def _batch_context(self, copies):
+        """Gives each copy of the cpo its own collision bit, so that the
+        copies only collide with themselves and with the floor."""
+        if len(copies) == 1:
+            yield
+            return
+
+        for icopy, (pcpos, _) in enumerate(copies):
+            for pcpo in pcpos:
+                pcpo.setCollideMask(BitMask32.bit(icopy))
+        yield
+        for pcpos, _ in copies:
+            for pcpo in pcpos:
+                pcpo.setCollideMask(BitMask32.allOn())
+
+    def _simulate(self, datas, noise, force, kappas, pcpos, rec_cpos,
+                  rec_ints, rec_slots, noise_key=None):
+        """Simulates the conditions with the given `kappas`, recording
+        them into `datas`. All the conditions share the same noise and
+        force: the first is simulated with the cpo itself, and the
+        others with the copies in `self.copies`, all stepped together
+        in the same physics world.
+
+        The states are recorded before and after the noise, and after
+        each of the record intervals `rec_ints`. `rec_slots` gives the
+        row of the data that each of these records goes into, or None
+        for the records that aren't kept (which are then not read out
+        at all).
+
+        """
         # Get simulation parameters
         step_size = self.bbase.sim_par["size"]
         n_substeps = self.bbase.sim_par["n_subs"]
 
-        # Store pre-noise states
-        read(data[0], rec_cpos)
-
-        # Add position noise
-        self._add_noise(rec_cpos, pcpos, noise)
+        # The cpo and the copies that we are using, as pairs of all
+        # their pcpos and the pcpos that we record
+        copies = [(self.cpo.descendants(type_=PSO), rec_cpos)] + [
+            copy[1:] for copy in self.copies[:len(datas) - 1]]
 
-        # Store post-noise states
-        read(data[1], rec_cpos)
+        # Store pre-noise states
+        if rec_slots[0] is not None:
+            with self.timer("read"):
+                for data, (_, cpos) in zip(datas, copies):
+                    read(data[rec_slots[0]], cpos)
+
+        # Add position noise -- or, if a previous condition already
+        # used this noise, skip the repel and restore the states (and
+        # velocities) it ended up with, rather than whatever the
+        # previous condition left behind
+        with self.timer("noise"):
+            if noise_key in self.repel_cache:
+                cached, velocities = self.repel_cache[noise_key]
+                write(cached, rec_cpos)
+                write_velocities(velocities, rec_cpos)
+            else:
+                self._add_noise(rec_cpos, pcpos, noise)
+
+        # Store post-noise states, and move the copies to the same
+        # positions, with the same velocities
+        post = np.empty(datas[0].shape[1:])
+        with self.timer("read"):
+            read(post, rec_cpos)
+            velocities = read_velocities(rec_cpos)
+        if noise_key is not None:
+            self.repel_cache[noise_key] = (post, velocities)
+        with self.timer("noise"):
+            for _, cpos in copies[1:]:
+                write(post, cpos)
+                write_velocities(velocities, cpos)
+        if rec_slots[1] is not None:
+            for data in datas:
+                data[rec_slots[1]] = post
 
         # Update masses
-        self._set_masses(kappa, rec_cpos)
+        with self.timer("set_masses"):
+            for kappa, (_, cpos) in zip(kappas, copies):
+                self._set_masses(kappa, cpos)
 
         # Set up force function
         force_dur = self.params['physics']['force_duration']
-        force_pcpos = [x.node() for x in rec_cpos]
+        force_pcpos = [x.node() for _, cpos in copies for x in cpos]
         force_vecpos = get_force(force['dir'], force['mag'])
 
+        # All the pcpos that need to be in the physics world
+        sim_pcpos = list(pcpos)
+        for copy_pcpos, _ in copies[1:]:
+            sim_pcpos.extend(copy_pcpos)
+
+        # Optionally stop early, once all the recorded pcpos have been
+        # at rest for `rest_intervals` record intervals in a row
+        rest_thresh = self.params['simulation'].get('rest_threshold', None)
+        rest_intervals = self.params['simulation'].get('rest_intervals', 1)
+        rest_pcpos = [x for _, cpos in copies for x in cpos]
+        n_rest = 0
+
         condition_time = 0.
-        with self._sim_context(pcpos):
+        with self._batch_context(copies), self._sim_context(sim_pcpos):
             # Iterative over record intervals.
             for i, interval in enumerate(rec_ints, start=2):
 
@@ -229,63 +501,291 @@ class Simulation(Process):
                     tforce = None
 
                 # Simulate physics for this recording interval.
-                self.bbase.step(size, n_subs, force=tforce)
+                with self.timer("step"):
+                    self.bbase.step(size, n_subs, force=tforce)
                 condition_time += size
 
                 # Store the cpos' states.
-                read(data[i], rec_cpos)
-
-                # Sanity check, to make sure the blocks are all above
-                # the floor
-                if (data[i][..., 2] < 0).any():
-                    mp.util.info("Object z-positions are negative!")
-
-            self.cache.restore()
-
-        return condition_time
+                if rec_slots[i] is not None:
+                    with self.timer("read"):
+                        for data, (_, cpos) in zip(datas, copies):
+                            read(data[rec_slots[i]], cpos)
+
+                            # Sanity check, to make sure the blocks are
+                            # all above the floor
+                            if (data[rec_slots[i]][..., 2] < 0).any():
+                                mp.util.info(
+                                    "Object z-positions are negative!")
+
+                if rest_thresh is None or condition_time < force_dur:
+                    continue
+                if at_rest(rest_pcpos, rest_thresh):
+                    n_rest += 1
+                else:
+                    n_rest = 0
+
+                # Nothing is going to move anymore, so fill in the
+                # rest of the data with the current states.
+                if n_rest >= rest_intervals:
+                    later = [x for x in rec_slots[i + 1:] if x is not None]
+                    for data, (_, cpos) in zip(datas, copies):
+                        if not later:
+                            break
+                        if rec_slots[i] is None:
+                            read(data[later[0]], cpos)
+                        else:
+                            data[later[0]] = data[rec_slots[i]]
+                        data[later[1:]] = data[later[0]]
+                    self.skipped_time += len(datas) * step_size * sum(
+                        rec_ints[i - 1:])
+                    break
+
+            with self.timer("restore"):
+                self.cache.restore()
+
+        return condition_time * len(datas)
+
+    def _checkpoint_paths(self):
+        """Paths of the checkpoint data and of the checkpoint's
+        completion bitmap. They include a hash of the conditions, so
+        that we never resume from a checkpoint of a different task with
+        the same name. Speculative duplicates of a task, which may run
+        at the same time as the original attempt, get their own."""
+        data_path = path(self.task["data_path"])
+        key = hashlib.md5(json.dumps(self.task['conditions'])).hexdigest()
+        prefix = "%s.%s" % (data_path.namebase, key[:8])
+        if self.task.get('speculative', False):
+            prefix += ".speculative"
+        return (data_path.dirname().joinpath(prefix + ".partial.npy"),
+                data_path.dirname().joinpath(prefix + ".done.npy"))
+
+    def _open_checkpoint(self):
+        """Open the checkpoint of the current task (creating it if it
+        does not exist yet) as memory maps of the data, and of which
+        conditions have been completed."""
+        data_path, done_path = self._checkpoint_paths()
+        shape = tuple(self.task['shape'])
+
+        if data_path.exists() and done_path.exists():
+            alldata = np.lib.format.open_memmap(data_path, mode='r+')
+            done = np.lib.format.open_memmap(done_path, mode='r+')
+            if alldata.shape == shape and done.shape == shape[:1]:
+                mp.util.info("Resuming task '%s' (%d/%d conditions done)" % (
+                    self.task['task_name'], done.sum(), len(done)))
+                return alldata, done
+            del alldata, done
+
+        # Create the checkpoint under temporary names and then move it
+        # into place, the bitmap last, so that an existing checkpoint
+        # (which another attempt may have open) is never truncated, and
+        # a checkpoint without its bitmap is never resumed from.
+        if not data_path.dirname().exists():
+            data_path.dirname().makedirs_p()
+        suffix = ".%s.%d.tmp" % (socket.gethostname(), os.getpid())
+        alldata = np.lib.format.open_memmap(
+            data_path + suffix, mode='w+', dtype=float, shape=shape)
+        done = np.lib.format.open_memmap(
+            done_path + suffix, mode='w+', dtype=bool, shape=shape[:1])
+        os.rename(data_path + suffix, data_path)
+        os.rename(done_path + suffix, done_path)
+        return alldata, done
+
+    def _remove_checkpoint(self):
+        for pth in self._checkpoint_paths():
+            try:
+                pth.remove()
+            except OSError:
+                pass
+
+    def _batches(self, conditions):
+        """Groups consecutive conditions that only differ in kappa into
+        batches of at most `self.batch_size`, and yields the indices of
+        the conditions in each batch."""
+        batch = []
+        for icond, cond in enumerate(conditions):
+            (iS, S), (iP, P), (iK, K), (isamp, samp) = cond
+            key = (iS, iP, isamp)
+            if batch and (batch_key != key or len(batch) == self.batch_size):
+                yield batch
+                batch = []
+            batch.append(icond)
+            batch_key = key
+        if batch:
+            yield batch
 
     def simulate_all(self):
 
         ## Assorted parameters.
-        icpo = self.task["icpo"]
         conditions = self.task['conditions']
 
-        ## Set up the cpo.
-        pcpos, record_cpos = self._prepare_scene(
-            path(self.task["cpo_path"]),
-            path(self.task["floor_path"]),
-            self.task['bodies'])
+        ## Group the conditions that can be simulated together.
+        batches = list(self._batches(conditions))
+        n_copies = max(len(batch) for batch in batches)
 
-        # Determine recording intervals
+        ## Set up the cpo.
+        with self.timer("prepare_scene"):
+            pcpos, record_cpos = self._prepare_scene(
+                path(self.task["cpo_path"]),
+                path(self.task["floor_path"]),
+                self.task['bodies'],
+                n_copies=n_copies)
+
+        # Determine recording intervals, and where each of the records
+        # that we keep goes in the data
         record_intervals = self.task['record_intervals']
-        # Allocate data storage.
-        alldata = np.zeros(self.task['shape'])
-
-        # enumerate over the parameters of each condition
-        for icond, cond in enumerate(conditions):
-            (iS, S), (iP, P), (iK, K), (isamp, samp) = cond
-
-            data = alldata[icond]
-            # shape of noises is (n_sigmas, n_samples, n_objs)
-            noise = self.params['noises'][iS, icpo, isamp]
-            # shape of forces is (n_forces, n_samples, n_objs)
-            force = self.params['forces'][iP, icpo, isamp]
+        n_records = len(record_intervals) + 2
+        record_keep = self.task.get('record_keep', None)
+        if record_keep is None:
+            record_keep = range(n_records)
+        record_slots = [None] * n_records
+        for slot, irecord in enumerate(record_keep):
+            record_slots[irecord] = slot
+        # Allocate data storage. If we are saving the data, it goes
+        # into a checkpoint, from which a retry of this task can pick
+        # up where we left off.
+        if self.save:
+            alldata, done = self._open_checkpoint()
+        else:
+            alldata = np.zeros(self.task['shape'])
+            done = np.zeros(len(conditions), dtype=bool)
+
+        # Tables of the statistics that the reducers compute for each
+        # condition
+        reducers = [
+            REDUCERS[name](self.task, self.params)
+            for name in self.params['simulation'].get('reducers', [])]
+        reduced = dict(
+            (reducer.name, np.empty((len(conditions), len(reducer.columns))))
+            for reducer in reducers)
+        store_trajectories = self.params['simulation'].get(
+            'store_trajectories', True)
+
+        # Post-repel states only depend on the noise, i.e. on the sigma
+        # and the sample (the stimulus is fixed for the whole task), so
+        # they can be shared between conditions
+        self.repel_cache = {}
+
+        # enumerate over the parameters of each batch of conditions
+        for batch in batches:
+            if done[batch].all():
+                self._reduce(reducers, reduced, alldata, batch)
+                continue
+
+            (iS, S), (iP, P), (iK, K), (isamp, samp) = conditions[batch[0]]
+
+            datas = [alldata[icond] for icond in batch]
+            kappas = [float(conditions[icond][2][1]) for icond in batch]
+            # the task holds the noise and force of each condition
+            noise = self.task['noises'][batch[0]]
+            force = self.task['forces'][batch[0]]
 
             self.sim_time += self._simulate(
-                data, noise, force, float(K), pcpos,
-                record_cpos, record_intervals)
+                datas, noise, force, kappas, pcpos,
+                record_cpos, record_intervals, record_slots,
+                noise_key=(iS, isamp))
+            self._reduce(reducers, reduced, alldata, batch)
+
+            # Make sure the data is on disk before marking it as done.
+            if self.save:
+                alldata.flush()
+                done[batch] = True
+                done.flush()
+
+        if self.stream and store_trajectories:
+            self.result = pack(alldata, compress=self.compress)
+        if reducers:
+            self.reduced = reduced
 
         if self.save:
-            # Write data to file.
+            # Write data to file. We write to a temporary file first,
+            # so that if another attempt at the same task is running,
+            # neither of them can see a partially written file.
             data_path = path(self.task["data_path"])
-            if not data_path.dirname().exists():
-                data_path.dirname().makedirs()
-            np.save(data_path, alldata)
+            tmp_path = "%s.%d.tmp" % (data_path, os.getpid())
+            compact = self.params['simulation'].get('compact_storage', None)
+            if store_trajectories:
+                if data_path.ext == '.npz':
+                    save_posquat(
+                        tmp_path, alldata,
+                        quaternions=compact or 'quantized')
+                else:
+                    with open(tmp_path, "wb") as fh:
+                        np.save(fh, np.asarray(alldata))
+                os.rename(tmp_path, data_path)
+            save_reduced(self.task, reduced)
+            del alldata, done
+            self._remove_checkpoint()
+
+            if self.profile:
+                timing_path = data_path.dirname().joinpath(
+                    "%s.timing.json" % data_path.namebase)
+                with open(timing_path, "w") as fh:
+                    json.dump(self.timing(), fh, indent=2)
 
             # Mark simulation as complete.
             self.task["complete"] = True
 
-        self._clean_scene()
+        self.repel_cache = {}
+        with self.timer("clean_scene"):
+            self._clean_scene()
+
+    def _reduce(self, reducers, reduced, alldata, batch):
+        """Run the reducers on the data of the conditions in `batch`."""
+        with self.timer("reduce"):
+            for icond in batch:
+                for reducer in reducers:
+                    reduced[reducer.name][icond] = reducer.reduce(
+                        alldata[icond])
+
+    def timing(self):
+        """The time spent in each phase of the current task, in total
+        and per condition (or None, if we are not profiling)."""
+        return self.timer.summary(len(self.task['conditions']))
+
+    def run_task(self, task):
+        """Run all the conditions of `task`, reusing the resources that
+        have already been prepared."""
+        self.task = task
+        # tasks from a server that runs several simulation scripts
+        # bring their own parameters
+        if 'physics' in task:
+            self.params = {
+                'physics': task['physics'],
+                'simulation': task['simulation'],
+            }
+            # a world created with a different number of solver
+            # iterations has to be created again
+            if self._solver_iterations() != self.solver_iterations:
+                self._clean_resources()
+                self._prepare_resources()
+            self._configure_physics()
+        self.sim_time = 0
+        self.skipped_time = 0
+        self.result = None
+        self.reduced = None
+        self.timer = PhaseTimer() if self.profile else NullTimer()
+        self.start_time = datetime.now()
+        try:
+            self.simulate_all()
+        except:
+            self._clean_scene()
+            raise
+        self.end_time = datetime.now()
+
+        # print out information about the task in a thread-safe
+        # manner (so information isn't interleaved across tasks)
+        self.print_info()
+
+        if self.conn is not None:
+            self.conn.send({
+                'task_name': task['task_name'],
+                'data': self.result,
+                'reduced': self.reduced,
+                'sim_time': self.sim_time,
+                'timing': self.timing(),
+            })
+        self.result = None
+        self.reduced = None
 
     def print_info(self):
         self.info_lock.acquire()
@@ -297,10 +797,20 @@ class Simulation(Process):
         mp.util.info("-" * 60)
         mp.util.info("Total sim. time   : %s" % str(
             timedelta(seconds=self.sim_time)))
+        if self.skipped_time > 0:
+            skipped = 100 * self.skipped_time / (
+                self.sim_time + self.skipped_time)
+            mp.util.info("Skipped sim. time : %s (%.1f%%)" % (
+                str(timedelta(seconds=self.skipped_time)), skipped))
         mp.util.info("Total real time   : %s" % str(dt))
         mp.util.info("Avg. per condition: %s" % str(avg))
         mp.util.info("Num conditions    : %d" % n_conditions)
         mp.util.info("Speedup is %.1f%%" % speedup)
+        timing = self.timing()
+        if timing:
+            for phase in sorted(timing, key=lambda x: -timing[x]['seconds']):
+                mp.util.info("  %-16s: %s" % (phase, str(
+                    timedelta(seconds=timing[phase]['seconds']))))
         mp.util.info("-" * 60)
 
         sys.stdout.flush()
@@ -311,8 +821,7 @@ class Simulation(Process):
         self._prepare_resources()
 
         try:
-            self.start_time = datetime.now()
-            self.simulate_all()
+            self.run_task(self.task)
 
         except KeyboardInterrupt:
             mp.util.debug("Keyboard interrupt!")
@@ -322,11 +831,52 @@ class Simulation(Process):
             mp.util.debug("Error: %s" % err)
             raise
 
-        else:
-            self.end_time = datetime.now()
-            # print out information about the task in a thread-safe
-            # manner (so information isn't interleaved across tasks)
-            self.print_info()
+        finally:
+            # Clean simulation resources.
+            self._clean_resources()
+
+
+class SimulationWorker(Simulation):
+    """Long-lived simulation process. The Bullet world and the floor
+    are set up once, and then tasks are received over `conn` and run
+    one after another, swapping only the tower in the scene. After
+    each task, the name of the task (and its data, if streaming) is
+    sent back over `conn`. Sending `None` stops the worker.
+
+    If a task fails, the worker exits (rather than trying to carry on
+    with a scene in an unknown state), and it is up to the owner of
+    the worker to start a new one.
+
+    """
+
+    def __init__(self, conn, params, info_lock, save=False, batch_size=1,
+                 stream=False, compress=False, profile=False):
+        super(SimulationWorker, self).__init__(
+            None, params, info_lock, save=save, batch_size=batch_size,
+            stream=stream, compress=compress, conn=conn, profile=profile)
+
+    def run(self):
+        """Run tasks until told to stop."""
+        self._prepare_resources()
+
+        try:
+            while True:
+                try:
+                    task = self.conn.recv()
+                except EOFError:
+                    break
+                if task is None:
+                    break
+
+                self.run_task(task)
+
+        except KeyboardInterrupt:
+            mp.util.debug("Keyboard interrupt!")
+            sys.exit(100)
+
+        except Exception as err:
+            mp.util.debug("Error: %s" % err)
+            raise
 
         finally:
             # Clean simulation resources.
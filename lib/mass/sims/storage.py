@@ -0,0 +1,138 @@
+from datapackage import load_posquat
+from itertools import izip
+from path import path
+import hashlib
+import numpy as np
+import zlib
+
+
+def pack(data, compress=False):
+    """Pack an array into a dictionary that can be cheaply sent between
+    processes (and over the network), optionally compressing it."""
+    data = np.ascontiguousarray(data)
+    buf = data.tostring()
+    if compress:
+        buf = zlib.compress(buf)
+    return {
+        'shape': data.shape,
+        'dtype': data.dtype.str,
+        'compressed': compress,
+        'data': buf,
+    }
+
+
+def unpack(packed):
+    """Unpack an array that was packed with `pack`."""
+    buf = packed['data']
+    if packed['compressed']:
+        buf = zlib.decompress(buf)
+    data = np.fromstring(buf, dtype=np.dtype(packed['dtype']))
+    return data.reshape(packed['shape'])
+
+
+def load_data(filename):
+    """Load the data of a task, which is either a plain .npy array or
+    (with compact storage) a .npz file in the encoding of
+    `datapackage.save_posquat`."""
+    filename = path(filename)
+    if filename.ext == '.npz':
+        return load_posquat(filename)
+    return np.load(filename)
+
+
+class ResultStore(object):
+    """A single memory-mapped array holding all the simulations of a
+    script, with one axis for each of the script's `index_names`
+    (sigma, phi, kappa, stimulus, sample, timestep, object, posquat).
+
+    Alongside it, we keep a boolean array (with just the condition
+    axes) that records which conditions have been written, so we can
+    tell whether the store is complete, and a hash of the simulation
+    script the store was created for, so that the results of an
+    earlier script are never taken for those of the current one.
+
+    """
+
+    def __init__(self, filename, params):
+        self.filename = path(filename)
+        self.written_filename = self.filename.dirname().joinpath(
+            "%s.written.npy" % self.filename.namebase)
+        self.key_filename = self.filename.dirname().joinpath(
+            "%s.key" % self.filename.namebase)
+
+        index_names = params['index_names']
+        index_levels = params['index_levels']
+        self.shape = tuple(len(index_levels[x]) for x in index_names)
+        self.n_cond_axes = index_names.index('timestep')
+
+        script_file = path(params['script_root']).joinpath("script.json")
+        with open(script_file, "rb") as fh:
+            self.key = hashlib.md5(fh.read()).hexdigest()
+
+        self.data = None
+        self.written = None
+
+    def exists(self):
+        return (self.filename.exists() and
+                self.written_filename.exists() and
+                self.key_filename.exists())
+
+    def _stored_key(self):
+        with open(self.key_filename, "r") as fh:
+            return fh.read().strip()
+
+    def remove(self):
+        """Delete the store, if there is one."""
+        for pth in (self.key_filename, self.written_filename,
+                    self.filename):
+            if pth.exists():
+                pth.remove()
+        self.data = None
+        self.written = None
+
+    def open(self, create=False):
+        """Open the store, creating it if it doesn't exist (or if it
+        has the wrong shape, or was created for a different script) and
+        `create` is True."""
+        if self.exists() and self._stored_key() == self.key:
+            data = np.lib.format.open_memmap(self.filename, mode='r+')
+            written = np.lib.format.open_memmap(
+                self.written_filename, mode='r+')
+            if (data.shape == self.shape and
+                    written.shape == self.shape[:self.n_cond_axes]):
+                self.data = data
+                self.written = written
+                return self
+            del data, written
+
+        if not create:
+            raise IOError("no store at %s" % self.filename)
+
+        if not self.filename.dirname().exists():
+            self.filename.dirname().makedirs_p()
+        self.data = np.lib.format.open_memmap(
+            self.filename, mode='w+', dtype=float, shape=self.shape)
+        self.written = np.lib.format.open_memmap(
+            self.written_filename, mode='w+', dtype=bool,
+            shape=self.shape[:self.n_cond_axes])
+        with open(self.key_filename, "w") as fh:
+            fh.write(self.key)
+        return self
+
+    def write(self, task, data):
+        """Write the data of a task into the slots of its conditions."""
+        icpo = task['icpo']
+        index = []
+        for cond, cond_data in izip(task['conditions'], data):
+            (iS, S), (iP, P), (iK, K), (isamp, samp) = cond
+            self.data[iS, iP, iK, icpo, isamp] = cond_data
+            index.append((iS, iP, iK, icpo, isamp))
+
+        # Make sure the data is on disk before marking it as written.
+        self.data.flush()
+        for idx in index:
+            self.written[idx] = True
+        self.written.flush()
+
+    def complete(self):
+        return self.written is not None and self.written.all()
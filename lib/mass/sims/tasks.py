@@ -1,8 +1,87 @@
-from itertools import product as iproduct
+from itertools import izip, product as iproduct
 from path import path
 import json
+import os
 import numpy as np
 from mass import CPO_PATH
+from reducers import FallReducer, reduced_path
+
+
+def with_slices(task, noises, forces):
+    """Returns a copy of `task` that also holds the noises and forces
+    for each of its conditions, so that the clients do not have to
+    look them up in the (much larger) arrays for the whole script.
+
+    Parameters
+    ----------
+    task : dict
+        The task
+    noises : np.ndarray
+        Position noise, with shape (n_sigmas, n_stims, n_samples,
+        n_objs, 3)
+    forces : np.ndarray
+        Forces, with shape (n_phis, n_stims, n_samples)
+
+    """
+    icpo = task['icpo']
+    idx = np.array(
+        [(iS, iP, isamp) for (iS, S), (iP, P), (iK, K), (isamp, samp)
+         in task['conditions']], dtype=int)
+
+    task = dict(task)
+    task['noises'] = noises[idx[:, 0], icpo, idx[:, 2]]
+    task['forces'] = forces[idx[:, 1], icpo, idx[:, 2]]
+    return task
+
+
+def wilson_width(p, n, z):
+    """Width of the Wilson score interval of a proportion `p` estimated
+    from `n` samples, where `z` is the normal quantile of the interval's
+    confidence. Unlike the normal approximation, the interval doesn't
+    collapse when every sample gives the same proportion (e.g. all the
+    towers are stable). For the mean of `n` proportions (rather than
+    of `n` coin flips), p * (1 - p) bounds the variance, so the
+    interval is conservative."""
+    z2 = z ** 2 / float(n)
+    return 2 * z * np.sqrt(p * (1 - p) / n + z2 / (4 * n)) / (1 + z2)
+
+
+def is_deterministic(sigma, phi):
+    """Whether conditions with position noise `sigma` and force `phi`
+    come out the same for every sample. With neither noise nor force,
+    nothing about the simulation is random."""
+    return sigma == 0 and phi == 0
+
+
+def split_chunks(conditions, chunk_size):
+    """Split a list of conditions into chunks of at most `chunk_size`
+    conditions, and return the indices of the conditions in each
+    chunk. Consecutive conditions with the same sigma and sample use
+    the same position noise (so the simulation can reuse the repelled
+    tower between them), so we try not to split such a run of
+    conditions across chunks.
+
+    """
+    runs = []
+    run_key = None
+    for icond, ((iS, S), (iP, P), (iK, K), (isamp, samp)) in \
+            enumerate(conditions):
+        if runs and run_key == (iS, isamp):
+            runs[-1].append(icond)
+        else:
+            runs.append([icond])
+        run_key = (iS, isamp)
+
+    run_size = max(len(run) for run in runs)
+    if run_size <= chunk_size:
+        n_chunks = int(np.ceil(len(runs) / float(chunk_size // run_size)))
+        chunks = [
+            np.concatenate([runs[i] for i in idx])
+            for idx in np.array_split(np.arange(len(runs)), n_chunks)]
+    else:
+        n_chunks = int(np.ceil(len(conditions) / float(chunk_size)))
+        chunks = np.array_split(np.arange(len(conditions)), n_chunks)
+    return chunks
 
 
 class Tasks(dict):
@@ -19,8 +98,14 @@ class Tasks(dict):
         return tasks
 
     @classmethod
-    def create(cls, params):
-        """Create the tasks dictionary from the parameters."""
+    def create(cls, params, costs=None, target_duration=None):
+        """Create the tasks dictionary from the parameters. If `costs`
+        (a `TaskCosts`) has measurements for a stimulus, and
+        `target_duration` is given, the stimulus' conditions are split
+        into chunks that should each take about `target_duration`
+        seconds to simulate (and at most `max_chunk_size` conditions).
+
+        """
 
         sim_root = path(params["sim_root"])
         if not sim_root.exists():
@@ -32,7 +117,13 @@ class Tasks(dict):
         index_names = params['index_names']
         index_levels = params['index_levels']
         cpos_rec_names = index_levels['object']
-        record_intervals = list(np.diff(index_levels['timestep'][1:]))
+
+        # All the timesteps that are recorded, and which of them are
+        # kept in the data (older scripts always keep all of them)
+        record_steps = params.get('record_steps', index_levels['timestep'])
+        record_intervals = list(np.diff(record_steps[1:]))
+        record_keep = [
+            record_steps.index(x) for x in index_levels['timestep']]
 
         cond_names = [
             'sigma',
@@ -42,22 +133,61 @@ class Tasks(dict):
             'sample',
         ]
 
-        conditions = list(iproduct(*[
-            enumerate(index_levels[x]) for x in cond_names
-            if x != 'stimulus']))
-        n_conditions = len(conditions)
-        n_chunks = int(np.ceil(n_conditions / float(params['max_chunk_size'])))
-        chunks = np.array_split(np.arange(n_conditions), n_chunks, axis=0)
+        # Conditions with the same sigma and sample use the same
+        # position noise, so the simulation can reuse the repelled
+        # tower between them. We therefore order the conditions so
+        # that these are next to each other.
+        levels = dict((x, list(enumerate(index_levels[x])))
+                      for x in cond_names if x != 'stimulus')
+        # with adaptive kappa refinement, we start out with just the
+        # coarse kappa grid (see `refine`)
+        if 'kappa_refinement' in params:
+            coarse = params['kappa_refinement']['coarse']
+            levels['kappa'] = [levels['kappa'][i] for i in coarse]
+        # with sequential sampling, we start out with the first wave of
+        # samples (see `next_wave`)
+        if 'sequential_sampling' in params:
+            wave_size = params['sequential_sampling']['wave_size']
+            levels['sample'] = levels['sample'][:wave_size]
+        conditions = [
+            (s, p, k, n) for s, n, p, k in iproduct(
+                levels['sigma'], levels['sample'],
+                levels['phi'], levels['kappa'])]
+
+        # Deterministic conditions are the same for every sample, so
+        # we only simulate their first sample (`process_simulations`
+        # copies it to the others)
+        if params.get('deduplicate', False):
+            conditions = [
+                (s, p, k, n) for s, p, k, n in conditions
+                if n[0] == 0 or not is_deterministic(s[1], p[1])]
+
         base_shape = [
             len(index_levels[x]) for x in index_names
             if x not in cond_names]
 
+        max_chunk_size = params['max_chunk_size']
+        # with compact storage, the data is saved as compressed .npz
+        # files instead of plain .npy arrays
+        if params['simulation'].get('compact_storage', None):
+            data_ext = ".npz"
+        else:
+            data_ext = ".npy"
+        if costs is None:
+            costs = TaskCosts()
+
         tasks = cls()
-        completed = cls()
         for icpo, cp in enumerate(cpo_paths):
+            chunk_size = max_chunk_size
+            cost = costs.per_condition(cp.namebase)
+            if cost and target_duration:
+                chunk_size = int(np.clip(
+                    target_duration / cost, 1, max_chunk_size))
+
+            chunks = split_chunks(conditions, chunk_size)
             for ichunk, chunk_idx in enumerate(chunks):
                 sim_name = "%s_%s_%02d" % (cp.namebase, params["tag"], ichunk)
-                data_path = sim_root.joinpath("%s.npy" % sim_name)
+                data_path = sim_root.joinpath(sim_name + data_ext)
                 chunk = [conditions[i] for i in chunk_idx]
                 shape = [len(chunk)] + base_shape
 
@@ -73,10 +203,315 @@ class Tasks(dict):
                     "seed": abs(hash(sim_name)),
                     "conditions": chunk,
                     "record_intervals": record_intervals,
+                    "record_keep": record_keep,
                     "shape": shape,
                     "num_tries": 0,
                 }
 
-                completed[sim_name] = False
+        return tasks
+
+    def _outcomes(self, failed=()):
+        """The fall statistics of every condition that has been
+        simulated so far, keyed by (icpo, sigma, phi, kappa, sample),
+        where each of the latter is an (index, value) pair. Also returns
+        the set of keys of every condition that has been scheduled
+        (including those whose tasks failed, so they aren't scheduled
+        again), and the first task of each stimulus.
+
+        Every task that isn't in `failed` must have its fall statistics
+        next to its data; otherwise an IOError is raised.
+
+        """
+        outcomes = {}
+        scheduled = set()
+        templates = {}
+        for task_name in sorted(self.keys()):
+            task = self[task_name]
+            templates.setdefault(task['icpo'], task)
+            keys = [(task['icpo'],) + tuple(map(tuple, cond))
+                    for cond in task['conditions']]
+            scheduled.update(keys)
+
+            if task_name in failed:
+                continue
+            table_path = reduced_path(task['data_path'], FallReducer.name)
+            if not table_path.exists():
+                raise IOError(
+                    "no fall statistics for task '%s' at %s (the clients "
+                    "must stream their results, or share a filesystem "
+                    "with the server)" % (task_name, table_path))
+            table = np.load(table_path)
+            outcomes.update(izip(keys, table))
+
+        return outcomes, scheduled, templates
+
+    def _add_round(self, params, new_conditions, templates):
+        """Add tasks for the conditions in `new_conditions` (a list of
+        conditions for each stimulus index), based on the other tasks
+        of each stimulus in `templates`. The tasks of each round get
+        their own names. Returns the names of the new tasks."""
+        rnd = 1 + max(task.get('round', 0) for task in self.itervalues())
+        names = []
+        for icpo in sorted(new_conditions):
+            # keep conditions with the same noise next to each other
+            conditions = sorted(
+                new_conditions[icpo],
+                key=lambda x: (x[0][0], x[3][0], x[1][0], x[2][0]))
+            template = templates[icpo]
+            sim_root = path(template['data_path']).dirname()
+            data_ext = path(template['data_path']).ext
+            stim = path(template['cpo_path']).namebase
+
+            chunks = split_chunks(conditions, params['max_chunk_size'])
+            for ichunk, chunk_idx in enumerate(chunks):
+                sim_name = "%s_%s_%02d_r%d" % (
+                    stim, params['tag'], ichunk, rnd)
+                chunk = [conditions[i] for i in chunk_idx]
+
+                task = dict(template)
+                task.update({
+                    "data_path": str(sim_root.joinpath(sim_name + data_ext)),
+                    "task_name": sim_name,
+                    "seed": abs(hash(sim_name)),
+                    "conditions": chunk,
+                    "shape": [len(chunk)] + template['shape'][1:],
+                    "num_tries": 0,
+                    "round": rnd,
+                })
+                self[sim_name] = task
+                names.append(sim_name)
+
+        return names
+
+    def refine(self, params, failed=()):
+        """Add the tasks of the next round of adaptive kappa refinement.
+
+        For each stimulus, sigma and phi, we go through the kappas that
+        have been simulated so far, in order. Wherever two neighbouring
+        kappas have a different number of fallen blocks, or total
+        movements that differ by more than the script's
+        `movement_tolerance`, in any of the samples, the kappa halfway
+        between them (on the script's kappa grid) is scheduled for all
+        of the samples, so that every kappa is averaged over the same
+        samples. This needs the fall statistics of each task (except
+        those in `failed`), next to its data (see
+        `reducers.FallReducer`).
+
+        Returns the names of the new tasks, which is empty once the
+        outcomes have been resolved everywhere.
+
+        """
+        refinement = params['kappa_refinement']
+        tolerance = refinement['movement_tolerance']
+        kappas = params['index_levels']['kappa']
+        infell = FallReducer.columns.index('nfell')
+        imoved = FallReducer.columns.index('total movement')
+
+        outcomes, scheduled, templates = self._outcomes(failed)
+        by_kappa = {}
+        for (icpo, S, P, (iK, K), samp), stats in outcomes.iteritems():
+            by_kappa.setdefault((icpo, S, P), {}).setdefault(
+                iK, {})[samp] = stats
+
+        new_conditions = {}
+        for key in sorted(by_kappa):
+            icpo, S, P = key
+            stats = by_kappa[key]
+            samples = sorted(set().union(*stats.values()))
+            done = sorted(stats)
+            for a, b in izip(done[:-1], done[1:]):
+                mid = (a + b) // 2
+                if mid == a:
+                    continue
+                resolved = True
+                for samp in set(stats[a]) & set(stats[b]):
+                    sa, sb = stats[a][samp], stats[b][samp]
+                    same_nfell = sa[infell] == sb[infell]
+                    same_moved = abs(sa[imoved] - sb[imoved]) <= tolerance
+                    if not (same_nfell and same_moved):
+                        resolved = False
+                        break
+                if resolved:
+                    continue
+                for samp in samples:
+                    cond = (S, P, (mid, kappas[mid]), samp)
+                    if (icpo,) + cond not in scheduled:
+                        new_conditions.setdefault(icpo, []).append(cond)
+
+        return self._add_round(params, new_conditions, templates)
+
+    def next_wave(self, params, failed=()):
+        """Add the tasks of the next wave of sequential sampling.
+
+        For each stimulus, sigma, phi and kappa, we estimate the
+        proportion of blocks that fell (the model's `percent_fell`)
+        from the samples simulated so far, with a Wilson score
+        confidence interval (see `wilson_width`). Where the interval is
+        wider than the script's `max_width`, the next `wave_size`
+        samples are scheduled, up to the script's number of samples.
+        This needs the fall statistics of each task, next to its data
+        (see `reducers.FallReducer`).
+
+        Returns the names of the new tasks, which is empty once all the
+        estimates have converged (or run out of samples).
+
+        """
+        sampling = params['sequential_sampling']
+        wave_size = sampling['wave_size']
+        max_width = sampling['max_width']
+        z = sampling['z']
+        samples = params['index_levels']['sample']
+        infell = FallReducer.columns.index('nfell')
+
+        outcomes, scheduled, templates = self._outcomes(failed)
+        fell = {}
+        for (icpo, S, P, K, samp), stats in outcomes.iteritems():
+            n_objs = float(len(templates[icpo]['bodies']))
+            fell.setdefault((icpo, S, P, K), []).append(
+                stats[infell] / n_objs)
+        next_sample = {}
+        for (icpo, S, P, K, (isamp, samp)) in scheduled:
+            key = (icpo, S, P, K)
+            next_sample[key] = max(next_sample.get(key, 0), isamp + 1)
+
+        new_conditions = {}
+        for key in sorted(fell):
+            icpo, S, P, K = key
+            first = next_sample[key]
+            if first >= len(samples) or is_deterministic(S[1], P[1]):
+                continue
+            x = np.array(fell[key])
+            if wilson_width(x.mean(), len(x), z) <= max_width:
+                continue
+            for isamp in xrange(first, min(first + wave_size, len(samples))):
+                new_conditions.setdefault(icpo, []).append(
+                    (S, P, K, (isamp, samples[isamp])))
+
+        return self._add_round(params, new_conditions, templates)
+
+    def split(self, task_name, chunk_size):
+        """Replace a task with several smaller tasks, each with at most
+        `chunk_size` of its conditions. Returns the names of the new
+        tasks."""
+        task = self[task_name]
+        chunks = split_chunks(task['conditions'], chunk_size)
+        if len(chunks) == 1:
+            return [task_name]
+
+        del self[task_name]
+        sim_root = path(task['data_path']).dirname()
+        data_ext = path(task['data_path']).ext
+        names = []
+        for ichunk, chunk_idx in enumerate(chunks):
+            sim_name = "%s-%d" % (task_name, ichunk)
+            chunk = [task['conditions'][i] for i in chunk_idx]
+
+            subtask = dict(task)
+            subtask.update({
+                "data_path": str(sim_root.joinpath(sim_name + data_ext)),
+                "task_name": sim_name,
+                "seed": abs(hash(sim_name)),
+                "conditions": chunk,
+                "shape": [len(chunk)] + task['shape'][1:],
+                "num_tries": 0,
+            })
+            self[sim_name] = subtask
+            names.append(sim_name)
+
+        return names
+
+
+class TaskCosts(dict):
+    """Measured costs of simulating each stimulus, as the total wall
+    time (in seconds) and total number of conditions of its completed
+    tasks. These are kept across runs, so they can be used to plan
+    later runs of the same stimuli."""
+
+    def save(self, filename):
+        with open(path(filename), "w") as fh:
+            json.dump(self, fh)
+
+    @classmethod
+    def load(cls, filename):
+        costs = cls()
+        if path(filename).exists():
+            with open(path(filename), "r") as fh:
+                costs.update(json.load(fh))
+        return costs
+
+    def add(self, stim, seconds, n_conditions):
+        """Record a completed task for `stim`."""
+        total_seconds, total_conditions = self.get(stim, (0., 0))
+        self[stim] = (total_seconds + seconds,
+                      total_conditions + n_conditions)
+
+    def per_condition(self, stim):
+        """Average wall time per condition for `stim`, or None if
+        nothing has been measured yet."""
+        total_seconds, total_conditions = self.get(stim, (0., 0))
+        if total_conditions == 0:
+            return None
+        return total_seconds / float(total_conditions)
+
+    def mean_per_condition(self):
+        """Average wall time per condition over all stimuli, or None if
+        nothing has been measured yet."""
+        if not self:
+            return None
+        total_seconds, total_conditions = map(sum, zip(*self.values()))
+        if total_conditions == 0:
+            return None
+        return total_seconds / float(total_conditions)
+
+    def estimate(self, task):
+        """Estimated wall time for `task`, or None if its stimulus has
+        not been measured yet."""
+        cost = self.per_condition(path(task['cpo_path']).namebase)
+        if cost is None:
+            return None
+        return cost * len(task['conditions'])
+
+
+class CompletionLog(object):
+    """Append-only log of the names of completed tasks, one per line.
+    Recording a completion only appends a line to the file, rather
+    than rewriting a record of every task. Tasks may be logged more
+    than once; `compact` rewrites the log without the duplicates.
+
+    """
+
+    def __init__(self, filename):
+        self.filename = path(filename)
+
+    def load(self):
+        """Return the set of names of completed tasks. An unterminated
+        last line (e.g. from a crash in the middle of a write) is
+        ignored."""
+        if not self.filename.exists():
+            return set()
+        with open(self.filename, "r") as fh:
+            lines = fh.read().split("\n")[:-1]
+        return set(line for line in lines if line)
+
+    def append(self, task_name):
+        """Record `task_name` as completed."""
+        with open(self.filename, "a") as fh:
+            fh.write("%s\n" % task_name)
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def save(self, task_names):
+        """Replace the log with `task_names`."""
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w") as fh:
+            for task_name in sorted(task_names):
+                fh.write("%s\n" % task_name)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmp, self.filename)
 
-        return tasks, completed
+    def compact(self):
+        """Rewrite the log with each completed task once."""
+        completed = self.load()
+        self.save(completed)
+        return completed
@@ -10,6 +10,18 @@ def parse_address(address):
     return host, int(port)
 
 
+def parse_script(script):
+    """Parse a simulation script given as exp:tag[:weight[:priority]]
+    into an (exp, tag, weight, priority) tuple."""
+    parts = script.split(":")
+    if not 2 <= len(parts) <= 4:
+        raise ValueError("invalid simulation script: %s" % script)
+    exp, tag = parts[:2]
+    weight = float(parts[2]) if len(parts) > 2 else 1
+    priority = int(parts[3]) if len(parts) > 3 else 0
+    return exp, tag, weight, priority
+
+
 def get_params(exp, tag):
     """Load the parameters from the simulation script."""
     sim_root = SIM_PATH.joinpath(exp, tag)
@@ -22,6 +34,10 @@ def get_params(exp, tag):
     script["script_root"] = str(script_root)
     script["sim_root"] = str(sim_root)
     script["tasks_path"] = str(sim_root.joinpath("tasks.json"))
+    script["completed_path"] = str(sim_root.joinpath("completed.log"))
+    script["costs_path"] = str(sim_root.joinpath("costs.json"))
+    script["store_path"] = str(sim_root.joinpath("simulations.npy"))
+    script["metrics_path"] = str(sim_root.joinpath("metrics.jsonl"))
     script["forces"] = np.load(force_file)
     script["noises"] = np.load(noise_file)
     return script